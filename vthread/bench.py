@@ -0,0 +1,365 @@
+'''
+#==============================================================
+# vthread 的性能测试脚本
+#
+# 不依赖网络，也不 sleep，只测量库本身的调度开销
+# 结果以 JSON 输出，保存下来就可以在不同版本之间对比是否有性能退化
+# 使用方式：
+#     python -m vthread.bench                  # 全部测试，JSON 打印到标准输出
+#     python -m vthread.bench -o base.json     # 保存到文件
+#     python -m vthread.bench --quick          # 缩小任务量，快速跑一遍
+#     python -m vthread.bench -k dispatch wait # 只跑名字里包含这些关键字的测试
+#==============================================================
+'''
+import os
+import builtins
+import sys
+import json
+import time
+import queue
+import platform
+import argparse
+import subprocess
+import threading
+import tracemalloc
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+
+import vthread
+from vthread.vthread import _RunCounter, log_flag, _log_flush, _new_print, _org_print
+
+
+def _noop(*args):
+    pass
+
+def _cpu_task(n):
+    # CPU 密集型的任务，进程池测试使用，需要放在模块顶层才能被子进程找到
+    return sum(i*i for i in range(n))
+
+def bench_counter(n=1000000):
+    '''
+    #==============================================================
+    # 对比每个任务的计数开销
+    # queue: 以前每个任务在 _monitor_run_num 上做的一次 put/get
+    # counter: 现在的 _RunCounter 的一次 incr/decr
+    # 返回值为每个任务的平均耗时（微秒）
+    #==============================================================
+    '''
+    q = queue.Queue()
+    t = time.perf_counter()
+    for _ in range(n):
+        q.put('V')
+        q.get('V')
+    old = (time.perf_counter() - t) / n * 1e6
+    c = _RunCounter()
+    t = time.perf_counter()
+    for _ in range(n):
+        c.incr()
+        c.decr()
+    new = (time.perf_counter() - t) / n * 1e6
+    return {"queue_us": old, "counter_us": new}
+
+def bench_pool(n=200000, num=4):
+    '''
+    #==============================================================
+    # 测量 pool 装饰的空函数从提交到全部执行完毕的平均每任务耗时（微秒）
+    #==============================================================
+    '''
+    gqueue = 'bench_pool_{}'.format(num)
+    func = vthread.pool(num,gqueue=gqueue,log=False)(_noop)
+    vthread.pool.wait(gqueue)
+    t = time.perf_counter()
+    for _ in range(n):
+        func()
+    vthread.pool.wait(gqueue)
+    cost = (time.perf_counter() - t) / n * 1e6
+    vthread.pool.close_by_gqueue(gqueue)
+    return {"workers": num, "tasks": n, "per_task_us": cost}
+
+def bench_process(tasks=16, n=1000000, nums=(1,2,4)):
+    '''
+    #==============================================================
+    # 对比线程池和进程池执行 CPU 密集型任务的耗时（秒）
+    # 线程池受 GIL 限制，线程数增加耗时基本不变
+    # 进程池在 CPU 核心足够的情况下耗时应接近线性下降
+    #==============================================================
+    '''
+    ret = []
+    for backend in ('thread','process'):
+        for num in nums:
+            gqueue = 'bench_{}_{}'.format(backend,num)
+            func = vthread.pool(num,gqueue=gqueue,log=False,backend=backend)(_cpu_task)
+            func(1).result() # 预热，子进程在第一次任务时启动
+            t = time.perf_counter()
+            for fut in [func(n) for _ in range(tasks)]:
+                fut.result()
+            ret.append({"backend": backend, "workers": num, "seconds": time.perf_counter() - t})
+            vthread.pool.close_by_gqueue(gqueue)
+    return ret
+
+def bench_steal(depth=15, num=8):
+    '''
+    #==============================================================
+    # 递归扇出的场景（类似爬虫在任务中继续提交任务）
+    # 对比普通队列和工作窃取模式从提交到全部执行完毕的耗时（秒）
+    #==============================================================
+    '''
+    ret = []
+    for scheduler in ('fifo','steal'):
+        gqueue = 'bench_{}'.format(scheduler)
+        p = vthread.pool(num,gqueue=gqueue,log=False,scheduler=scheduler)
+        @p
+        def node(depth):
+            if depth:
+                node(depth-1)
+                node(depth-1)
+        t = time.perf_counter()
+        node(depth)
+        vthread.pool.wait(gqueue)
+        ret.append({"scheduler": scheduler, "workers": num, "tasks": 2**(depth+1)-1,
+                    "seconds": time.perf_counter() - t})
+        vthread.pool.close_by_gqueue(gqueue)
+    return ret
+
+def bench_dispatch(n=100000, num=4):
+    '''
+    #==============================================================
+    # 单个任务的派发开销（微秒），空函数从提交到全部执行完毕的平均耗时
+    # pool: vthread.pool
+    # executor: concurrent.futures.ThreadPoolExecutor，作为对比的基准
+    # thread / thread_reuse: vthread.thread 每次调用开新线程 / 复用缓存线程
+    # thread 每次调用都会等待线程结束，所以任务数取 n 的百分之一
+    #==============================================================
+    '''
+    ret = {"workers": num, "tasks": n}
+    ret["pool_us"] = bench_pool(n,num)["per_task_us"]
+    with ThreadPoolExecutor(num) as ex:
+        futures_wait([ex.submit(_noop) for _ in range(num)])
+        t = time.perf_counter()
+        for _ in range(n):
+            ex.submit(_noop)
+        ex.shutdown(wait=True)
+        ret["executor_us"] = (time.perf_counter() - t) / n * 1e6
+    m = max(n // 100, 1)
+    for key, reuse in (("thread_us",False),("thread_reuse_us",True)):
+        func = vthread.thread(1,join=True,log=False,reuse=reuse)(_noop)
+        t = time.perf_counter()
+        for _ in range(m):
+            func()
+        ret[key] = (time.perf_counter() - t) / m * 1e6
+    return ret
+
+def bench_throughput(n=100000, nums=(1,2,4,8,16)):
+    '''
+    #==============================================================
+    # 吞吐量（任务/秒）随伺服线程数的变化，对比 ThreadPoolExecutor
+    # 空函数只能体现调度本身的扩展性，线程越多锁竞争越多，一般是下降的
+    #==============================================================
+    '''
+    ret = []
+    for num in nums:
+        cost = bench_pool(n,num)["per_task_us"]
+        with ThreadPoolExecutor(num) as ex:
+            t = time.perf_counter()
+            for _ in range(n):
+                ex.submit(_noop)
+            ex.shutdown(wait=True)
+            ecost = (time.perf_counter() - t) / n * 1e6
+        ret.append({"workers": num, "pool_tasks_per_s": 1e6 / cost,
+                    "executor_tasks_per_s": 1e6 / ecost})
+    return ret
+
+def bench_wait(rounds=200, num=4):
+    '''
+    #==============================================================
+    # 最后一个任务执行完毕到 vthread.pool.wait() 返回之间的延迟（微秒）
+    # 每轮提交 num 个任务，记录任务结束的时间，和 wait 返回的时间相减
+    #==============================================================
+    '''
+    gqueue = 'bench_wait'
+    end = [0.0]
+    def _mark():
+        end[0] = time.perf_counter()
+    func = vthread.pool(num,gqueue=gqueue,log=False)(_mark)
+    lat = []
+    for _ in range(rounds):
+        for _ in range(num):
+            func()
+        vthread.pool.wait(gqueue)
+        lat.append((time.perf_counter() - end[0]) * 1e6)
+    vthread.pool.close_by_gqueue(gqueue)
+    lat.sort()
+    return {"rounds": rounds, "p50_us": lat[len(lat)//2],
+            "p99_us": lat[min(len(lat)-1,len(lat)*99//100)], "max_us": lat[-1]}
+
+def bench_memory(n=50000):
+    '''
+    #==============================================================
+    # 每个排队中的任务占用的内存（字节），用 tracemalloc 统计
+    # 伺服线程被一个任务阻塞住，提交的任务全部留在队列里
+    # 包括任务本身、参数和返回的 Future，对比 ThreadPoolExecutor
+    # pool_bytes 为普通的组，priority_bytes 为优先级模式的组
+    #==============================================================
+    '''
+    ret = {"tasks": n}
+    gate = threading.Event()
+    for key, kw in (("pool_bytes", {}), ("priority_bytes", {"priority": True})):
+        gqueue = 'bench_memory_' + key
+        func = vthread.pool(1,gqueue=gqueue,log=False,**kw)(_noop)
+        block = vthread.pool(1,gqueue=gqueue,log=False,**kw)(gate.wait)
+        block()
+        tracemalloc.start()
+        try:
+            base = tracemalloc.get_traced_memory()[0]
+            futs = [func(i) for i in range(n)]
+            ret[key] = (tracemalloc.get_traced_memory()[0] - base) / n
+        finally:
+            tracemalloc.stop()
+            gate.set()
+        del futs
+        vthread.pool.wait(gqueue)
+        vthread.pool.close_by_gqueue(gqueue)
+        gate.clear()
+    with ThreadPoolExecutor(1) as ex:
+        ex.submit(gate.wait)
+        tracemalloc.start()
+        try:
+            base = tracemalloc.get_traced_memory()[0]
+            futs = [ex.submit(_noop,i) for i in range(n)]
+            ret["executor_bytes"] = (tracemalloc.get_traced_memory()[0] - base) / n
+        finally:
+            tracemalloc.stop()
+            gate.set()
+        del futs
+    return ret
+
+# 在新的解释器中执行，导入 vthread 并在 gqueues 个组中各装饰一个函数
+_STARTUP = '''
+import sys, time, json, threading
+def rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * {page}
+    except OSError:
+        return None
+r0 = rss()
+t0 = time.perf_counter()
+import vthread
+t1 = time.perf_counter()
+for i in range({gqueues}):
+    vthread.pool({num}, gqueue="g%d" % i, log=False)(lambda x: x)
+t2 = time.perf_counter()
+r1 = rss()
+json.dump({{"import_ms": (t1 - t0) * 1e3, "decorate_ms": (t2 - t1) * 1e3,
+           "threads": threading.active_count(),
+           "rss_kb": None if r0 is None else (r1 - r0) // 1024}}, sys.stdout)
+'''
+
+def bench_startup(gqueues=50, num=8):
+    '''
+    #==============================================================
+    # 导入并装饰很多组的模块的启动开销，在新的子进程中测量
+    # import_ms: 导入 vthread 的时间（毫秒）
+    # decorate_ms: gqueues 个组各装饰一个 num 线程的函数的时间（毫秒）
+    # threads: 装饰完之后的线程数量（包括主线程）
+    # rss_kb: 导入和装饰增加的常驻内存，只在有 /proc 的系统上统计
+    #==============================================================
+    '''
+    page = os.sysconf("SC_PAGE_SIZE") if hasattr(os,"sysconf") else 4096
+    code = _STARTUP.format(gqueues=gqueues, num=num, page=page)
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(vthread.__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None,[root,env.get("PYTHONPATH")]))
+    out = subprocess.run([sys.executable,"-c",code],env=env,check=True,
+                         stdout=subprocess.PIPE).stdout
+    ret = {"gqueues": gqueues, "num": num}
+    ret.update(json.loads(out))
+    return ret
+
+def bench_print(lines=20000, nums=(1,4,16)):
+    '''
+    #==============================================================
+    # 多线程打印的锁竞争，num 个线程一共打印 lines 行到 os.devnull 的耗时（秒）
+    # builtin: 未打补丁的 print
+    # locked: vthread 的带锁 print
+    # async: toggle(True,"async") 打开后的异步 print
+    #==============================================================
+    '''
+    ret = []
+    old, old_print = log_flag._alog, builtins.print
+    with open(os.devnull,'w') as null, contextlib.redirect_stdout(null):
+        for mode in ('builtin','locked','async'):
+            # 直接替换 builtins.print，unpatch_all() 之后 patch_print() 装上的仍然是原版 print
+            builtins.print = _org_print if mode == 'builtin' else _new_print
+            log_flag._alog = mode == 'async'
+            for num in nums:
+                per = max(lines // num, 1)
+                def _run():
+                    for i in range(per):
+                        print('bench', i)
+                ts = [threading.Thread(target=_run) for _ in range(num)]
+                t = time.perf_counter()
+                for i in ts: i.start()
+                for i in ts: i.join()
+                _log_flush()
+                ret.append({"mode": mode, "threads": num, "lines": per*num,
+                            "seconds": time.perf_counter() - t})
+    log_flag._alog = old
+    builtins.print = old_print
+    return ret
+
+
+BENCHES = {
+    "counter":    (bench_counter,    {"n": 100000}),
+    "dispatch":   (bench_dispatch,   {"n": 10000}),
+    "throughput": (bench_throughput, {"n": 10000, "nums": (1,4,16)}),
+    "wait":       (bench_wait,       {"rounds": 50}),
+    "memory":     (bench_memory,     {"n": 5000}),
+    "print":      (bench_print,      {"lines": 2000}),
+    "process":    (bench_process,    {"tasks": 4, "n": 100000, "nums": (1,2)}),
+    "steal":      (bench_steal,      {"depth": 11}),
+    "startup":    (bench_startup,    {"gqueues": 10}),
+}
+
+def run(names=None, quick=False):
+    '''
+    #==============================================================
+    # 执行测试并返回可以直接 json.dumps 的字典
+    #     :names  只执行名字中包含这些关键字的测试，None 为全部执行
+    #     :quick  使用 BENCHES 中较小的任务量
+    #==============================================================
+    '''
+    vthread.unpatch_all(True)
+    ret = {
+        "vthread": vthread.__version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "quick": quick,
+        "results": {},
+    }
+    for name, (func, small) in BENCHES.items():
+        if names and not any(k in name for k in names):
+            continue
+        ret["results"][name] = func(**small) if quick else func()
+    return ret
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m vthread.bench",
+                                     description="vthread offline benchmarks, JSON output.")
+    parser.add_argument("-o","--output",help="write JSON to this file instead of stdout")
+    parser.add_argument("-k",nargs="*",dest="names",help="only run benches whose name contains one of these")
+    parser.add_argument("--quick",action="store_true",help="smaller workloads for a fast smoke run")
+    args = parser.parse_args(argv)
+    data = json.dumps(run(args.names,args.quick),indent=2)
+    if args.output:
+        with open(args.output,'w') as f:
+            f.write(data + "\n")
+    else:
+        # 伺服线程启动时会重新给 print 打补丁，直接写标准输出
+        sys.stdout.write(data + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -10,13 +10,30 @@
 # 可以通过执行 vthread.unpatch_all() 解除这个补丁还原 print
 #==============================================================
 '''
+import os
 import time
 import queue
 import traceback
-from threading import Thread,Lock,RLock,\
-                     current_thread,main_thread
+from threading import Thread,Lock,RLock,Event,Condition,Semaphore,current_thread
 import builtins
+import sys
+import atexit
 import functools
+import itertools
+import random
+import threading
+import collections
+import collections.abc
+import heapq
+import importlib
+import io
+import pickle
+import math
+import types
+import contextvars
+from concurrent.futures import CancelledError, TimeoutError
+# asyncio inspect multiprocessing cProfile pstats 导入较慢
+# 只在协程模式、进程池模式和采样分析时才在用到的地方导入，import vthread 保持轻量
 
 # 兼容 isAlive 函数被完全遗弃的新版
 Thread.isAlive = Thread.is_alive
@@ -27,21 +44,89 @@ class log_flag:
     _decorator_toggle = True
     _vlog = True # print是否显示线程名字
     _elog = True # 是否打印错误信息
+    _alog = False # print是否使用异步写入
+    _alog_drop = False # 异步写入的缓冲区满了时丢弃还是阻塞
+    _alog_maxsize = 10000 # 异步写入的缓冲区最多存放的条数
 
 
 # 所有被装饰的原始函数都会放在这个地方
 orig_func = {}
 
+# 异步 print 的缓冲区，deque 的 append 和 popleft 本身是线程安全的，不需要加锁
+_log_buffer  = collections.deque()
+_log_event   = Event()          # 缓冲区有数据时通知写入线程
+_log_space   = Condition(Lock()) # 缓冲区满时阻塞的 print 在这里等待
+_log_writer  = None
+_log_dropped = 0
+
+def _log_drain():
+    # 取出缓冲区内的所有记录一次性写入，调用时需要持有 lock 以保证输出顺序
+    records = []
+    while _log_buffer:
+        records.append(_log_buffer.popleft())
+    if records:
+        out = sys.stdout
+        if out is not None:
+            out.write(''.join(records))
+            out.flush()
+    return records
+
+def _log_writer_run():
+    while True:
+        _log_event.wait()
+        _log_event.clear()
+        with lock:
+            _log_drain()
+        with _log_space:
+            _log_space.notify_all()
+
+@atexit.register
+def _log_flush():
+    # 程序退出时把缓冲区中剩余的内容写完
+    with lock:
+        _log_drain()
+
+def _async_print(name,arg,kw):
+    global _log_writer, _log_dropped
+    sep = kw.get('sep')
+    sep = ' ' if sep is None else sep
+    end = kw.get('end')
+    end = '\n' if end is None else end
+    if name is not None:
+        arg = (name,) + arg
+    if len(_log_buffer) >= log_flag._alog_maxsize:
+        if log_flag._alog_drop:
+            _log_dropped += 1
+            return
+        with _log_space:
+            _log_event.set()
+            _log_space.wait_for(lambda:len(_log_buffer) < log_flag._alog_maxsize)
+    _log_buffer.append(sep.join(map(str,arg)) + end)
+    if not _log_event.is_set():
+        _log_event.set()
+    if _log_writer is None:
+        with lock:
+            if _log_writer is None:
+                _log_writer = Thread(target=_log_writer_run,name="LogWriter",daemon=True)
+                _log_writer.start()
+
 _org_print = print
 def _new_print(*arg,**kw):
-    lock.acquire()
+    name = None
     if log_flag._vlog:
-        name = current_thread().getName()
-        name = "[{}]".format(name.center(13))
-        _org_print(name,*arg,**kw)
-    else:
-        _org_print(*arg,**kw)
-    lock.release()
+        name = "[{}]".format(current_thread().name.center(13))
+    # 异步模式下只把格式化好的字符串放进缓冲区，由写入线程批量写入，不需要拿锁
+    # 指定了 file 或者 flush 的 print 仍然同步写入
+    if log_flag._alog and kw.get('file') is None and not kw.get('flush'):
+        _async_print(name,arg,kw)
+        return
+    with lock:
+        if _log_buffer:
+            _log_drain()
+        if name is not None:
+            _org_print(name,*arg,**kw)
+        else:
+            _org_print(*arg,**kw)
 
 
 def toggle(toggle=False,name="thread"):
@@ -51,14 +136,117 @@ def toggle(toggle=False,name="thread"):
     # 目前提供修改的参数有三个：
     # 1. "thread"  # 是否在print时在最左显示线程名字
     # 2. "error"   # 是否显示error信息
+    # 3. "async"   # print是否异步写入，默认关闭
+    #                打开后 print 只把格式化好的内容放进缓冲区
+    #                由一个写入线程批量写入 sys.stdout，线程之间不再争抢锁
+    # 4. "async_drop" # 异步写入的缓冲区满了（log_flag._alog_maxsize 条）时
+    #                   打开则丢弃新的内容，默认关闭即阻塞等待写入线程
     #==============================================================
     '''
     # 因为装饰器是每次装饰都会默认打开 _vlog 一次，所以添加这个参数放置
     # 使得这个函数一旦在最开始执行之后，装饰器就不会再打开 _vlog 了
-    global _monitor
     log_flag._decorator_toggle = False
     if name == "thread" : log_flag._vlog = toggle
     if name == "error"  : log_flag._elog = toggle
+    if name == "async_drop" : log_flag._alog_drop = toggle
+    if name == "async"  :
+        log_flag._alog = toggle
+        if not toggle: _log_flush()
+
+
+class _Latch:
+    '''
+    #==============================================================
+    # 倒数计数的门闩，thread(join=True) 用它等待所有线程执行完毕
+    # 使用缓存线程时线程不会结束，所以不能再用 Thread.join
+    #==============================================================
+    '''
+    __slots__ = ('_num','_cond')
+
+    def __init__(self,num):
+        self._num  = num
+        self._cond = Condition(Lock())
+
+    def count_down(self):
+        with self._cond:
+            self._num -= 1
+            if self._num <= 0:
+                self._cond.notify_all()
+
+    def wait(self,timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda:self._num <= 0,timeout)
+
+
+class _ThreadCache:
+    '''
+    #==============================================================
+    # vthread.thread 使用的缓存线程
+    # 执行完任务的线程不退出，空闲 thread.idle_timeout 秒后才退出
+    # 有空闲线程时直接交给空闲线程执行，没有时才开启新线程
+    #==============================================================
+    '''
+    def __init__(self):
+        self.jobs   = queue.SimpleQueue()
+        self.lock   = Lock()
+        self.idle   = 0     # 空闲并且还没有被预定的线程数量
+        self.closed = False
+
+    def submit(self,job):
+        with self.lock:
+            if self.closed:
+                reserved = None
+            elif self.idle:
+                self.idle -= 1
+                reserved = True
+            else:
+                reserved = False
+        if reserved is None:
+            # 主线程结束后不再缓存线程
+            Thread(target=job).start()
+            return
+        self.jobs.put(job)
+        if not reserved:
+            Thread(target=self._run).start()
+        pool.main_monitor()
+
+    def _run(self):
+        while True:
+            try:
+                job = self.jobs.get(timeout=thread.idle_timeout)
+            except queue.Empty:
+                with self.lock:
+                    # 还有其他没被预定的空闲线程时才能退出，否则可能有任务正要交给自己
+                    if self.idle > 0:
+                        self.idle -= 1
+                        return
+                continue
+            if job is None: return
+            job()
+            with self.lock:
+                if self.closed: return
+                self.idle += 1
+
+    def close(self):
+        # 通知所有空闲线程退出，正在执行任务的线程执行完后退出
+        with self.lock:
+            self.closed = True
+            num, self.idle = self.idle, 0
+        for _ in range(num): self.jobs.put(None)
+
+_thread_cache = _ThreadCache()
+
+
+def _thread_job(func,args,kw,latch):
+    # 这里包装一下异常捕捉，防止异常导致的不 join
+    try:
+        func(*args,**kw)
+    except Exception as e:
+        if log_flag._elog:
+            print(traceback.format_exc())
+    finally:
+        if latch is not None:
+            latch.count_down()
 
 
 class thread:
@@ -100,8 +288,20 @@ class thread:
     # 不过需要注意的是，不要将 vthread.thread 带参数和不带参数的装饰器混用
     # 可能会导致一些不可预知的异常。
     #==============================================================
+    # 频繁调用时每次创建和销毁线程的开销会很明显，这时可以使用缓存线程
+    #
+    # >>> @vthread.thread(3, reuse=True) # 执行完的线程空闲一段时间后才退出，下次调用直接复用
+    # ... def foolfunc():
+    # ...     print("foolstring")
+    # >>>
+    # >>> vthread.thread.reuse = True # 修改默认值，不带参数的装饰方式也会使用缓存线程
+    # >>> vthread.thread.idle_timeout = 5 # 缓存线程的空闲时间，默认 5 秒
+    #==============================================================
     '''
-    def __init__(self,num=1,join=False,log=True):
+    reuse = False
+    idle_timeout = 5
+
+    def __init__(self,num=1,join=False,log=True,reuse=None):
         '''
         #==============================================================
         # *args
@@ -109,24 +309,28 @@ class thread:
         # **kw
         #     :join  多线程是否join
         #     :log   print函数的输出时是否加入线程名作前缀
+        #     :reuse 是否使用缓存线程，默认使用 thread.reuse 的值
         #==============================================================
         '''
         # 为了兼容不带参数的装饰方式，这里做了如下修改。
         if type(num)==type(lambda:None): 
             def _no_params_func(self,*args,**kw):
+                patch_print()
+                if thread.reuse:
+                    _thread_cache.submit(functools.partial(_thread_job,num,args,kw,None))
+                    return
                 v = Thread(target=num,args=args,kwargs=kw)
                 v.start()
             thread.__call__ = _no_params_func
         else:
             self.num  = num
             self.join = join
+            self.reuse = reuse
 
         # 让配置在 toggle 执行变成只能手动配置 log_flag
         if log_flag._decorator_toggle:
             log_flag._vlog = log
-        
-        # 默认将 print 函数进行monkey patch
-        patch_print()        
+        # print 函数的 monkey patch 在第一次调用时才执行，装饰本身没有副作用
 
     def __call__(self,func):
         '''
@@ -137,6 +341,15 @@ class thread:
         orig_func[func.__name__] = func
         @functools.wraps(func)
         def _run_threads(*args,**kw):
+            patch_print()
+            reuse = thread.reuse if self.reuse is None else self.reuse
+            if reuse:
+                # 使用缓存线程时用门闩代替 join
+                latch = _Latch(self.num) if self.join else None
+                job = functools.partial(_thread_job,func,args,kw,latch)
+                for _ in range(self.num): _thread_cache.submit(job)
+                if latch is not None: latch.wait()
+                return
             p = []
             for _ in range(self.num):
                 # 这里包装一下异常捕捉，防止异常导致的不 join
@@ -156,6 +369,1203 @@ class KillThreadParams(Exception):
     '''一个用来杀死进程的函数参数'''
     pass
 
+class _WakeUp:
+    '''工作窃取模式下用来唤醒空闲线程去窃取任务的标记'''
+    pass
+
+# 记录当前线程属于哪个组的伺服线程，工作窃取模式使用
+# 以及 initializer 为这个伺服线程创建的资源
+_worker_local = threading.local()
+
+def _worker_init(init):
+    # 伺服线程（或子进程）启动时执行一次组的 initializer
+    # initializer 抛出异常时伺服线程照常运行，任务获取资源时再抛出，不会让整组卡住
+    _worker_local.resource   = None
+    _worker_local.init_error = None
+    if init is None or init[0] is None:
+        return
+    try:
+        _worker_local.resource = init[0]()
+    except BaseException as e:
+        _worker_local.init_error = e
+        if log_flag._elog:
+            print(traceback.format_exc())
+
+def _worker_final(init):
+    # 伺服线程退出时执行一次组的 finalizer，参数为 initializer 的返回值
+    try:
+        if init is not None and init[1] is not None and _worker_local.init_error is None:
+            init[1](_worker_local.resource)
+    except BaseException:
+        if log_flag._elog:
+            print(traceback.format_exc())
+    finally:
+        _worker_local.resource = _worker_local.init_error = None
+
+def worker_resource():
+    '''
+    #==============================================================
+    # 获取当前伺服线程的资源，也就是该组 initializer 的返回值
+    # 每个伺服线程只创建一次，例如每个线程一个 requests.Session 或者数据库连接
+    # 不在伺服线程中或者该组没有设置 initializer 时返回 None
+    # initializer 执行失败时抛出 RuntimeError
+    #
+    # >>> @vthread.pool(8, initializer=requests.Session, finalizer=lambda s:s.close())
+    # ... def crawl(url):
+    # ...     return vthread.worker_resource().get(url).text
+    #==============================================================
+    '''
+    e = getattr(_worker_local,'init_error',None)
+    if e is not None:
+        raise RuntimeError("worker initializer failed.") from e
+    return getattr(_worker_local,'resource',None)
+
+# Future 的几种状态
+_PENDING, _RUNNING, _FINISHED, _CANCELLED = range(4)
+
+# 当前正在执行的任务的 Future，协程模式下每个协程各自一份
+_current_future = contextvars.ContextVar('vthread_future',default=None)
+
+class CancelToken:
+    '''
+    #==============================================================
+    # 任务的协作取消标记，在任务内部通过 vthread.cancel_token() 获取
+    # 任务超时或者对正在执行的任务调用 Future.cancel() 时被标记为取消
+    # 线程无法被强制停止，耗时的任务可以在循环中自己检查是否需要提前结束
+    #
+    # >>> @vthread.pool(4, timeout=10)
+    # ... def crawl(urls):
+    # ...     token = vthread.cancel_token()
+    # ...     for url in urls:
+    # ...         token.raise_if_cancelled()
+    # ...         fetch(url, timeout=token.remaining())
+    #==============================================================
+    '''
+    __slots__ = ('deadline','_cancelled')
+
+    def __init__(self,deadline=None):
+        self.deadline   = deadline # time.monotonic() 的截止时间，None 为不限时
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def cancelled(self):
+        if self._cancelled: return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self):
+        # 距离截止时间还有多少秒，不限时返回 None
+        if self.deadline is None: return None
+        return max(self.deadline - time.monotonic(), 0)
+
+    def raise_if_cancelled(self):
+        if self.cancelled():
+            raise CancelledError()
+
+def cancel_token():
+    '''
+    #==============================================================
+    # 获取当前正在执行的 pool 任务的 CancelToken，不在任务中时返回 None
+    # 进程池模式下函数在子进程中执行，拿不到这个标记，超时时会直接结束子进程
+    #==============================================================
+    '''
+    fut = _current_future.get()
+    return None if fut is None else fut._get_token()
+
+
+class Future:
+    '''
+    #==============================================================
+    # 被 pool 装饰的函数每次调用都会返回一个 Future 对象
+    # 伺服线程执行完函数后会把返回值或者异常直接写进这个对象里
+    # 这样就不需要再额外开一个 queue.Queue 去回传结果了
+    #
+    # >>> import vthread
+    # >>>
+    # >>> @vthread.pool(3)
+    # ... def foolfunc(num):
+    # ...     return num * 2
+    # >>>
+    # >>> fs = [foolfunc(i) for i in range(5)]
+    # >>> [f.result() for f in fs] # 按提交顺序拿结果
+    # [0, 2, 4, 6, 8]
+    # >>> for f in vthread.as_completed(fs): # 按完成顺序拿结果
+    # ...     print(f.result())
+    # >>>
+    #==============================================================
+    # 用法和 concurrent.futures.Future 基本一致，不过更轻量一些
+    # 只有真的有线程在等待结果时才会创建 Event
+    #==============================================================
+    '''
+    __slots__ = ('_state','_result','_exception','_callbacks','_event','_lock','_token','_attempts')
+
+    def __init__(self):
+        self._state     = _PENDING
+        self._result    = None
+        self._exception = None
+        self._callbacks = None
+        self._event     = None
+        self._lock      = Lock()
+        self._token     = None # 设置了超时或者需要协作取消时才创建 CancelToken
+        self._attempts  = 0    # 已经重试的次数
+
+    def done(self):
+        return self._state >= _FINISHED
+
+    def running(self):
+        return self._state == _RUNNING
+
+    def cancelled(self):
+        return self._state == _CANCELLED
+
+    def cancel(self):
+        '''
+        #==============================================================
+        # 取消还在队列中等待的任务，已经开始执行或执行完毕的任务无法取消
+        # 正在执行的任务会被标记取消，任务可以通过 vthread.cancel_token() 检查
+        #==============================================================
+        '''
+        with self._lock:
+            if self._state == _CANCELLED: return True
+            if self._state == _RUNNING:
+                if self._token is None: self._token = CancelToken()
+                self._token.cancel()
+            if self._state != _PENDING:   return False
+        return self._finish(_CANCELLED)
+
+    def _get_token(self):
+        if self._token is None:
+            with self._lock:
+                if self._token is None: self._token = CancelToken()
+        return self._token
+
+    def _set_running(self):
+        # 伺服线程拿到任务时调用，返回 False 说明任务已经被取消，不需要执行
+        with self._lock:
+            if self._state != _PENDING: return False
+            self._state = _RUNNING
+            return True
+
+    def _set_pending(self):
+        # 任务需要重试时回到等待状态，等待重试期间仍然可以被取消
+        with self._lock:
+            if self._state != _RUNNING: return False
+            self._state = _PENDING
+            return True
+
+    # 返回 False 说明结果已经被设置过了（例如已经被看门狗判定为超时）
+    def _set_result(self,result):
+        return self._finish(_FINISHED,result=result)
+
+    def _set_exception(self,exception):
+        return self._finish(_FINISHED,exception=exception)
+
+    def _cancelled_by_token(self,exception):
+        # 任务响应协作取消抛出了 CancelledError，视为被取消而不是执行失败
+        token = self._token
+        return isinstance(exception,CancelledError) and token is not None and token._cancelled
+
+    def _finish(self,state,result=None,exception=None,running=False):
+        # running=True 时只结束正在执行的任务，看门狗使用
+        with self._lock:
+            if self._state >= _FINISHED: return False
+            if running and self._state != _RUNNING: return False
+            self._state     = state
+            self._result    = result
+            self._exception = exception
+            callbacks, self._callbacks = self._callbacks, None
+            event = self._event
+        if event is not None:
+            event.set()
+        if callbacks:
+            for fn in callbacks: self._invoke(fn)
+        return True
+
+    def _invoke(self,fn):
+        try:
+            fn(self)
+        except BaseException:
+            if log_flag._elog:
+                print(traceback.format_exc())
+
+    def _wait(self,timeout):
+        if self._state < _FINISHED:
+            with self._lock:
+                if self._state < _FINISHED and self._event is None:
+                    self._event = Event()
+                event = self._event
+            if not event.wait(timeout):
+                raise TimeoutError()
+        if self._state == _CANCELLED:
+            raise CancelledError()
+
+    def add_done_callback(self,fn):
+        '''
+        #==============================================================
+        # 任务结束（包括被取消）时调用 fn(future)
+        # 如果任务已经结束，则在当前线程立即调用
+        #==============================================================
+        '''
+        with self._lock:
+            if self._state < _FINISHED:
+                if self._callbacks is None:
+                    self._callbacks = []
+                self._callbacks.append(fn)
+                return
+        self._invoke(fn)
+
+    def result(self,timeout=None):
+        '''
+        #==============================================================
+        # 等待并返回函数的返回值，函数抛出的异常会在这里重新抛出
+        # 超时则抛出 TimeoutError，被取消则抛出 CancelledError
+        #==============================================================
+        '''
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self,timeout=None):
+        '''
+        #==============================================================
+        # 等待并返回函数抛出的异常，正常结束则返回 None
+        #==============================================================
+        '''
+        self._wait(timeout)
+        return self._exception
+
+    def __await__(self):
+        '''
+        #==============================================================
+        # 在协程中可以直接 await 被 pool 装饰的函数的返回值
+        #
+        # >>> async def main():
+        # ...     ret = await foolfunc(123)
+        #
+        # 结果通过 loop.call_soon_threadsafe 传回事件循环，不会阻塞事件循环
+        # 协程被取消时，还在排队的任务也会一起被取消
+        #==============================================================
+        '''
+        import asyncio
+        loop = asyncio.get_running_loop()
+        afut = loop.create_future()
+        def _copy(f):
+            if afut.done(): return
+            if f.cancelled():
+                afut.cancel()
+            elif f._exception is not None:
+                afut.set_exception(f._exception)
+            else:
+                afut.set_result(f._result)
+        def _done(f):
+            try:
+                loop.call_soon_threadsafe(_copy,f)
+            except RuntimeError:
+                pass # 事件循环已经关闭
+        def _cancel(a):
+            if a.cancelled(): self.cancel()
+        afut.add_done_callback(_cancel)
+        self.add_done_callback(_done)
+        return (yield from afut)
+
+    def __repr__(self):
+        state = ('pending','running','finished','cancelled')[self._state]
+        return '<vthread.Future at {:#x} state={}>'.format(id(self), state)
+
+
+class _RunCounter:
+    '''
+    #==============================================================
+    # 每组线程池一个，记录该组已经提交但还没执行完毕的任务数量
+    # 提交时加一，执行完毕（包括异常和取消）时减一
+    # 数量归零时通知所有在 wait 的线程，不需要再定时轮询
+    #
+    # 分条计数：每个线程有一个自己的 [提交数, 完成数, 线程]，只有这个线程自己写入
+    # 所以加一不需要加锁，也不依赖 += 是否是原子操作（无 GIL 的版本也一样）
+    # 读取时把所有线程的计数加起来，只有存在等待者时完成任务的线程才会去读
+    # 已经退出的线程的计数在有新线程加入时合并到第一格，列表不会一直变长
+    #==============================================================
+    '''
+    __slots__ = ('_local','_cells','_lock','_waiters','_cond')
+
+    def __init__(self):
+        self._local   = threading.local()
+        self._cells   = [[0,0,None]] # 第一格为已经退出的线程的计数之和
+        self._lock    = Lock()
+        self._waiters = 0
+        self._cond    = Condition(Lock())
+
+    def _cell(self):
+        # 当前线程第一次计数时注册自己的一格
+        cell = self._local.cell = [0,0,current_thread()]
+        with self._lock:
+            base, live = self._cells[0], []
+            for c in self._cells[1:]:
+                if c[2].is_alive():
+                    live.append(c)
+                else:
+                    base = [base[0] + c[0], base[1] + c[1], None]
+            # 整体替换列表，读取的线程拿到的总是一个完整的快照
+            self._cells = [base] + live + [cell]
+        return cell
+
+    def incr(self):
+        try:
+            self._local.cell[0] += 1
+        except AttributeError:
+            self._cell()[0] += 1
+
+    def decr(self):
+        try:
+            self._local.cell[1] += 1
+        except AttributeError:
+            self._cell()[1] += 1
+        if self._waiters and self.empty():
+            with self._cond:
+                self._cond.notify_all()
+
+    def submitted(self):
+        return sum(c[0] for c in self._cells)
+
+    def finished(self):
+        return sum(c[1] for c in self._cells)
+
+    def num(self):
+        # 先读完成数再读提交数，读到的数量只会偏大不会偏小，所以不会误判为空
+        # 两次读取各取一次快照，期间合并掉的线程计数已经在新快照的第一格里
+        finish = self.finished()
+        return self.submitted() - finish
+
+    def empty(self):
+        return not self.num()
+
+    def wait(self,timeout=None):
+        with self._cond:
+            self._waiters += 1
+            try:
+                return self._cond.wait_for(self.empty,timeout)
+            finally:
+                self._waiters -= 1
+
+
+# 耗时直方图的分桶：第 i 个桶的上界为 2**(i-_HIST_BASE) 秒
+# 即从 2**-17 秒（约 7.6 微秒）到 2**7 秒（128 秒），最后一个桶为 +Inf
+_HIST_BASE = 17
+_HIST_SIZE = 25
+_HIST_BOUNDS = [2.0 ** (i - _HIST_BASE) for i in range(_HIST_SIZE)]
+
+def _bucket(seconds):
+    if seconds <= 0: return 0
+    i = math.frexp(seconds)[1] + _HIST_BASE
+    return 0 if i < 0 else min(i,_HIST_SIZE)
+
+class _WorkerStats:
+    '''
+    #==============================================================
+    # 每个伺服线程一份的统计数据，只有该线程自己写入，所以不需要加锁
+    # 读取时把同组所有线程的数据合并在一起
+    #==============================================================
+    '''
+    __slots__ = ('completed','failed','cancelled','expired','timed_out','retried',
+                 'wait_sum','run_sum','wait_hist','run_hist')
+
+    def __init__(self):
+        self.completed = 0
+        self.failed    = 0
+        self.cancelled = 0
+        self.expired   = 0
+        self.timed_out = 0
+        self.retried   = 0
+        self.wait_sum  = 0.
+        self.run_sum   = 0.
+        self.wait_hist = [0] * (_HIST_SIZE + 1)
+        self.run_hist  = [0] * (_HIST_SIZE + 1)
+
+    def record(self,wait,run,state):
+        # state: 0 正常结束，1 抛出异常，2 已被取消，3 排队超时被丢弃，4 执行超时
+        #        5 抛出异常等待重试
+        if state == 2:
+            self.cancelled += 1
+            return
+        if state == 3:
+            self.expired += 1
+            return
+        if state == 5:   self.retried   += 1
+        elif state == 4: self.timed_out += 1
+        elif state == 1: self.failed    += 1
+        else:            self.completed += 1
+        self.wait_sum += wait
+        self.run_sum  += run
+        self.wait_hist[_bucket(wait)] += 1
+        self.run_hist[_bucket(run)]   += 1
+
+    def merge(self,other):
+        self.completed += other.completed
+        self.failed    += other.failed
+        self.cancelled += other.cancelled
+        self.expired   += other.expired
+        self.timed_out += other.timed_out
+        self.retried   += other.retried
+        self.wait_sum  += other.wait_sum
+        self.run_sum   += other.run_sum
+        for i,j in enumerate(other.wait_hist): self.wait_hist[i] += j
+        for i,j in enumerate(other.run_hist):  self.run_hist[i]  += j
+
+
+def _hist_dict(total,hist):
+    # 转换成累计计数的直方图，和 prometheus 的 histogram 格式一致
+    buckets, n = [], 0
+    for le,j in zip(_HIST_BOUNDS + [float('inf')], hist):
+        n += j
+        buckets.append((le,n))
+    return {"count": n, "sum": total, "buckets": buckets}
+
+
+class _Task:
+    '''
+    #==============================================================
+    # 队列中的一个任务，用 __slots__ 代替之前的元组，不再有 __dict__
+    #     func      被装饰的函数，同一个函数的所有任务共用同一个引用
+    #     args      位置参数
+    #     kw        关键字参数，没有关键字参数时为 None，不再为每个任务创建空字典
+    #     fut       返回给调用者的 Future
+    #     t         入队时间（perf_counter），用来统计等待时间
+    #     priority  优先级，只在优先级模式的组中使用
+    #     id        入队的序号，相同优先级的任务按序号先进先出
+    #               由优先级队列在入队时设置，其他模式不需要，为 None
+    # 没有关键字参数的任务少一个字典，优先级队列中也不需要再包一层元组
+    #==============================================================
+    '''
+    __slots__ = ('func','args','kw','fut','t','priority','id')
+
+    def __init__(self,func,args,kw,fut,priority=0):
+        self.func     = func
+        self.args     = args
+        self.kw       = kw or None
+        self.fut      = fut
+        self.t        = time.perf_counter()
+        self.priority = priority
+        self.id       = None
+
+    def __lt__(self,other):
+        # 优先级队列的堆直接存放任务
+        if self.priority != other.priority:
+            return self.priority < other.priority
+        return self.id < other.id
+
+
+class _PriorityQueue(queue.Queue):
+    '''
+    #==============================================================
+    # 优先级模式的组使用的队列，数字越小越先执行，相同优先级先进先出
+    # 堆中直接存放 _Task，按照 (priority, id) 排序
+    # 停止标记单独计数，排队中的任务都执行完了才会取到，线程才退出
+    #==============================================================
+    '''
+    def _init(self,maxsize):
+        self.queue = []
+        self.pills = 0
+        self._seq  = itertools.count()
+
+    def _qsize(self):
+        return len(self.queue) + self.pills
+
+    def _put(self,item):
+        if item is KillThreadParams:
+            self.pills += 1
+        else:
+            item.id = next(self._seq)
+            heapq.heappush(self.queue,item)
+
+    def _get(self):
+        if not self.queue:
+            self.pills -= 1
+            return KillThreadParams
+        return heapq.heappop(self.queue)
+
+
+class _FairQueue(queue.Queue):
+    '''
+    #==============================================================
+    # 公平调度模式的组使用的队列，每个被装饰的函数有一个自己的子队列
+    # 按照权重轮流从各个子队列中取任务（stride scheduling）
+    # 每个子队列有一个进度值，取出一个任务进度增加 1/权重，每次取进度最小的子队列
+    # 权重为 2 的函数得到的执行机会是权重为 1 的两倍
+    # 一个函数提交大量任务时，其他函数的任务不需要排在它们后面
+    # 停止标记单独计数，所有子队列都空了才会取到
+    #==============================================================
+    '''
+    def _init(self,maxsize):
+        self.flows   = {} # 有任务的子队列
+        self.active  = [] # 有任务的子队列的 (进度, 序号, 函数) 堆
+        self.passes  = {} # 每个函数当前的进度
+        self.weights = {} # 每个函数的权重，在装饰时设置
+        self.vtime   = 0. # 最近一次取出的任务的进度
+        self.pills   = 0
+        self.size    = 0
+        self._seq    = itertools.count()
+
+    def _qsize(self):
+        return self.size + self.pills
+
+    @staticmethod
+    def _key(item):
+        # pool.map 的任务按照被批量执行的函数区分
+        return item.args[0] if item.func is _run_chunk else item.func
+
+    def _put(self,item):
+        if item is KillThreadParams:
+            self.pills += 1
+            return
+        key = self._key(item)
+        d = self.flows.get(key)
+        if d is None:
+            d = self.flows[key] = collections.deque()
+            # 空闲过的函数从当前进度开始，不能攒下之前没用完的机会
+            p = max(self.passes.get(key,0.),self.vtime)
+            heapq.heappush(self.active,(p,next(self._seq),key))
+        d.append(item)
+        self.size += 1
+
+    def _get(self):
+        if not self.active:
+            self.pills -= 1
+            return KillThreadParams
+        p, _, key = heapq.heappop(self.active)
+        self.vtime = p
+        d = self.flows[key]
+        item = d.popleft()
+        self.size -= 1
+        p += 1. / self.weights.get(key,1)
+        self.passes[key] = p
+        if d: heapq.heappush(self.active,(p,next(self._seq),key))
+        else: del self.flows[key]
+        return item
+
+    def depths(self):
+        # 每个函数排队中的任务数量
+        with self.mutex:
+            return {getattr(k,'__qualname__',k):len(d) for k,d in self.flows.items()}
+
+
+def _run_chunk(func,chunk):
+    # 一次出队执行一整块参数，pool.map 使用
+    return [func(*args) for args in chunk]
+
+def _remaining(end):
+    # 将截止时间换算成剩余的等待时间，None 代表不限时
+    return None if end is None else max(end - time.time(), 0)
+
+
+class _Timer:
+    '''
+    #==============================================================
+    # 所有组共用的定时器线程，第一次使用时才启动
+    # 用一个按时间排序的堆保存定时任务，只在最早的任务到期时醒来
+    # 任务超时的看门狗就是在任务开始执行时放一个截止时间的定时任务
+    # 任务按时执行完毕就取消掉，所以回调函数要尽量轻量，不能阻塞
+    #==============================================================
+    '''
+    def __init__(self):
+        self._heap   = []
+        self._seq    = itertools.count()
+        self._cond   = Condition(Lock())
+        self._thread = None
+        self._dead   = 0 # 堆中已经取消的数量，太多时整理一次
+
+    def schedule(self,when,fn,*args):
+        # when 为 time.monotonic() 的时间，返回值用于 cancel
+        entry = [when,next(self._seq),fn,args]
+        with self._cond:
+            heapq.heappush(self._heap,entry)
+            if self._thread is None:
+                self._thread = Thread(target=self._run,name="VthreadTimer",daemon=True)
+                self._thread.start()
+            elif self._heap[0] is entry:
+                self._cond.notify()
+        return entry
+
+    def cancel(self,entry):
+        # 只做标记，到期时跳过，不用在堆中查找
+        with self._cond:
+            if entry[2] is None: return
+            entry[2] = entry[3] = None
+            self._dead += 1
+            if self._dead > 64 and self._dead * 2 > len(self._heap):
+                self._heap = [i for i in self._heap if i[2] is not None]
+                heapq.heapify(self._heap)
+                self._dead = 0
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        entry = heapq.heappop(self._heap)
+                        fn, args = entry[2], entry[3]
+                        if fn is None:
+                            self._dead -= 1
+                            continue
+                        entry[2] = entry[3] = None
+                        break
+                    self._cond.wait(delay)
+            try:
+                fn(*args)
+            except BaseException:
+                if log_flag._elog:
+                    print(traceback.format_exc())
+
+_timer = _Timer()
+
+
+class _Probe:
+    '''
+    #==============================================================
+    # 生命周期钩子、慢任务记录和采样分析
+    # 只有注册了钩子或者打开了慢任务记录、采样分析时才会创建
+    # 没有创建时伺服线程每个任务只多判断一次全局变量 _probe 是否为 None
+    #
+    # 钩子的参数为 (gqueue, func, wait, run)，error 钩子多一个 exception
+    #     submit  提交任务时，在提交任务的线程中执行，wait 和 run 为 None
+    #     start   开始执行时，run 为 None
+    #     finish  正常执行完毕时
+    #     error   抛出异常时（每次重试失败都会执行）
+    # wait 为任务在队列中等待的秒数，run 为任务执行的秒数
+    #==============================================================
+    '''
+    EVENTS = ('submit','start','finish','error')
+
+    def __init__(self):
+        self.lock     = Lock()
+        self.hooks    = {i:[] for i in self.EVENTS}
+        self.slow     = {} # 每组慢任务的阈值
+        self.slow_log = {} # 每组记录下来的慢任务
+        self.profile  = {} # 每个函数的 [每 N 次采样一次, 执行次数, pstats.Stats]
+
+    def empty(self):
+        return not (any(self.hooks.values()) or self.slow or self.profile)
+
+    def emit(self,event,*args):
+        for fn in self.hooks[event]:
+            try:
+                fn(*args)
+            except BaseException:
+                if log_flag._elog:
+                    print(traceback.format_exc())
+
+    def start(self,gqueue,func,args,kw,wait,thread):
+        # 任务开始执行前调用，返回值交给 finish
+        # thread 为执行任务的线程，为 None 时不采集堆栈也不做分析（协程和进程池）
+        self.emit('start',gqueue,func,wait,None)
+        rec = entry = prof = None
+        threshold = self.slow.get(gqueue)
+        if threshold is not None:
+            rec = {"gqueue": gqueue, "func": func, "args": args, "kw": kw,
+                   "wait": wait, "run": None, "stack": None,
+                   "thread": None if thread is None else thread.name}
+            if thread is not None:
+                # 执行到阈值时还没结束就记录下此时的堆栈，可以看到任务卡在哪里
+                entry = _timer.schedule(time.monotonic() + threshold,self._capture,rec,thread.ident)
+        p = self.profile.get(func)
+        if p is not None and thread is not None:
+            with self.lock:
+                p[1] += 1
+                sample = p[1] % p[0] == 0
+            if sample:
+                import cProfile
+                prof = cProfile.Profile()
+                try:
+                    prof.enable()
+                except ValueError:
+                    prof = None # 已经有其他的分析器在运行
+        return rec, entry, prof
+
+    def finish(self,ctx,gqueue,func,wait,run,error):
+        # 在任务的结果放进 Future 之前调用，result() 返回时慢任务已经记录、钩子已经执行
+        # 返回 None，调用的地方用返回值清空 ctx，避免重复调用
+        rec, entry, prof = ctx
+        if prof is not None:
+            prof.disable()
+            p = self.profile.get(func)
+            if p is not None:
+                import pstats
+                with self.lock:
+                    if p[2] is None: p[2] = pstats.Stats(prof)
+                    else:            p[2].add(prof)
+        if entry is not None:
+            _timer.cancel(entry)
+        if rec is not None and run >= self.slow.get(gqueue,0):
+            rec["run"] = run
+            rec["error"] = error
+            with self.lock:
+                self.slow_log.setdefault(gqueue,collections.deque(maxlen=100)).append(rec)
+        if error is None: self.emit('finish',gqueue,func,wait,run)
+        else:             self.emit('error',gqueue,func,wait,run,error)
+
+    @staticmethod
+    def _capture(rec,ident):
+        frame = sys._current_frames().get(ident)
+        if frame is not None:
+            rec["stack"] = ''.join(traceback.format_stack(frame))
+
+# 没有使用钩子、慢任务记录和采样分析时为 None
+_probe = None
+
+def _get_probe():
+    global _probe
+    if _probe is None:
+        _probe = _Probe()
+    return _probe
+
+
+def _load_vthread_func(module,qualname):
+    # 在子进程中通过模块名和函数名找回被装饰之前的原函数
+    obj = importlib.import_module(module)
+    for name in qualname.split('.'):
+        obj = getattr(obj,name)
+    return getattr(obj,'_vthread_func',obj)
+
+class _Pickler(pickle.Pickler):
+    '''
+    #==============================================================
+    # 被装饰过的函数在模块中的名字指向的是装饰后的函数
+    # 普通的 pickle 找不到原函数会直接报错，这里改成按名字传递
+    # 子进程里再通过 _vthread_func 拿到原函数
+    #==============================================================
+    '''
+    def reducer_override(self,obj):
+        if type(obj) is types.FunctionType:
+            module = getattr(obj,'__module__',None)
+            try:
+                target = importlib.import_module(module)
+                for name in obj.__qualname__.split('.'):
+                    target = getattr(target,name)
+            except Exception:
+                return NotImplemented
+            if target is not obj and getattr(target,'_vthread_func',None) is obj:
+                return _load_vthread_func, (module, obj.__qualname__)
+        return NotImplemented
+
+def _dumps(obj):
+    f = io.BytesIO()
+    _Pickler(f,pickle.HIGHEST_PROTOCOL).dump(obj)
+    return f.getvalue()
+
+class _RemoteTraceback(Exception):
+    # 用于把子进程中的异常堆栈挂在父进程的异常上
+    def __init__(self,tb):
+        self.tb = tb
+    def __str__(self):
+        return self.tb
+
+def _process_worker_loop(conn,init=None):
+    '''
+    #==============================================================
+    # 子进程的伺服函数，一直等待父进程中对应的伺服线程发来任务
+    # 收到空数据或者连接断开时退出
+    # 组的 initializer 和 finalizer 在子进程中执行
+    #==============================================================
+    '''
+    init = None if init is None else pickle.loads(init)
+    _worker_init(init)
+    try:
+        while True:
+            try:
+                data = conn.recv_bytes()
+            except (EOFError,OSError):
+                return
+            if not data:
+                return
+            try:
+                func,args,kw = pickle.loads(data)
+                ret = (True,func(*args,**kw))
+            except BaseException as e:
+                ret = (False,e,traceback.format_exc())
+            try:
+                data = _dumps(ret)
+            except BaseException as e:
+                # 返回值或者异常无法被序列化
+                data = _dumps((False,RuntimeError(repr(e)),traceback.format_exc()))
+            conn.send_bytes(data)
+    finally:
+        _worker_final(init)
+
+class _ProcessWorker:
+    '''
+    #==============================================================
+    # 进程池模式下每个伺服线程独占一个子进程
+    # 伺服线程从队列取出任务后序列化发给子进程执行并等待结果
+    # 子进程在两次任务之间保持运行，不需要每次重新创建
+    #==============================================================
+    '''
+    def __init__(self,ctx,init=None):
+        self._ctx  = ctx
+        self._init = init
+        self._conn = None
+        self._proc = None
+
+    def _start(self):
+        init = None if self._init is None else _dumps(self._init)
+        self._conn, child = self._ctx.Pipe()
+        self._proc = self._ctx.Process(target=_process_worker_loop,args=(child,init),daemon=True)
+        self._proc.start()
+        child.close()
+
+    def call(self,func,args,kw):
+        data = _dumps((func,args,kw))
+        if self._proc is None:
+            self._start()
+        try:
+            self._conn.send_bytes(data)
+            ret = pickle.loads(self._conn.recv_bytes())
+        except (EOFError,OSError):
+            # 子进程意外退出，下次执行任务时重新启动
+            self.close()
+            from concurrent.futures.process import BrokenProcessPool
+            raise BrokenProcessPool("worker process exited abruptly.")
+        if ret[0]:
+            return ret[1]
+        e = ret[1]
+        e.__cause__ = _RemoteTraceback(ret[2])
+        raise e
+
+    def kill(self):
+        # 任务超时时由看门狗调用，等待结果的伺服线程会收到连接断开
+        proc = self._proc
+        if proc is not None:
+            proc.kill()
+
+    def close(self):
+        if self._proc is None:
+            return
+        try:
+            self._conn.send_bytes(b'')
+        except (EOFError,OSError):
+            pass
+        self._proc.join()
+        self._conn.close()
+        self._proc = self._conn = None
+
+
+class RateLimiter:
+    '''
+    #==============================================================
+    # 令牌桶限速器，用于限制某组线程池每秒开始执行的任务数量
+    #
+    # >>> import vthread
+    # >>>
+    # >>> @vthread.pool(8, gqueue='api', rate='100/s', burst=20) # 每秒最多100个任务，最多突发20个
+    # ... def call_api(num): pass
+    # >>>
+    # >>> # 多个组共用一个限速器，例如访问同一个网站的不同函数
+    # >>> limiter = vthread.RateLimiter('10/s', burst=5, concurrency=4)
+    # >>> pool1 = vthread.pool(8, gqueue=1, rate=limiter)
+    # >>> pool2 = vthread.pool(8, gqueue=2, rate=limiter)
+    #
+    # rate 可以是数字（每秒的数量）或者 '100/s' '600/m' '3600/h' 格式的字符串
+    # concurrency 限制同时执行的任务数量，None 为不限制，此时 rate 也可以为 None
+    # 伺服线程先等到令牌再取出任务执行，不需要在任务里面 sleep
+    # 等待令牌时任务仍在队列中排队，可以被取消，也不会超过队列长度的限制
+    #==============================================================
+    '''
+    _units = {'s':1, 'm':60, 'h':3600}
+
+    def __init__(self,rate,burst=1,concurrency=None):
+        self.rate  = self._parse_rate(rate)
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = Lock()
+        self._sem  = None if concurrency is None else Semaphore(concurrency)
+
+    @classmethod
+    def _parse_rate(self,rate):
+        if rate is None:
+            return None
+        if isinstance(rate,str):
+            num, _, unit = rate.partition('/')
+            return float(num) / self._units[unit.strip() or 's']
+        return float(rate)
+
+    def _reserve(self):
+        # 令牌可以预支成负数，返回需要等待的秒数，多个线程按预支的顺序依次等待
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        if self.rate:
+            wait = self._reserve()
+            if wait > 0:
+                time.sleep(wait)
+        if self._sem is not None:
+            self._sem.acquire()
+
+    def release(self):
+        if self._sem is not None:
+            self._sem.release()
+
+    def _refund(self):
+        # 拿到令牌后没有执行任务，令牌还回去
+        if self.rate:
+            with self._lock:
+                self._tokens = min(self.burst, self._tokens + 1)
+        self.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self,*exc):
+        self.release()
+
+
+class _CallCache:
+    '''
+    #==============================================================
+    # 被 pool 装饰的函数的调用缓存，每个被装饰的函数一个
+    # 1. 参数相同并且还没执行完的调用直接共用同一个 Future（single-flight）
+    # 2. maxsize > 0 时正常结束的结果放进 LRU 缓存，ttl 秒后过期
+    # 抛出异常或者被取消的调用不会被缓存
+    #==============================================================
+    '''
+    def __init__(self,maxsize=0,ttl=None):
+        self.maxsize   = maxsize
+        self.ttl       = ttl
+        self.lock      = Lock()
+        self.inflight  = {}
+        self.results   = collections.OrderedDict()
+        self.hits      = 0
+        self.misses    = 0
+        self.shared    = 0
+        self.evictions = 0
+
+    # 分隔位置参数和关键字参数的标记，和 functools._make_key 一样
+    # 否则 f(1, a=2) 和 f((1,), (('a',2),)) 会得到相同的键
+    _kwd_mark = (object(),)
+
+    @classmethod
+    def make_key(self,args,kw):
+        key = args + self._kwd_mark + tuple(sorted(kw.items())) if kw else args
+        hash(key) # 参数不可哈希时抛出 TypeError
+        return key
+
+    def call(self,args,kw,submit):
+        try:
+            key = self.make_key(args,kw)
+        except TypeError:
+            return submit(None) # 不可哈希的参数不走缓存
+        with self.lock:
+            if key in self.results:
+                fut, expire = self.results[key]
+                if expire is None or expire > time.monotonic():
+                    self.results.move_to_end(key)
+                    self.hits += 1
+                    return fut
+                del self.results[key]
+                self.evictions += 1
+            if key in self.inflight:
+                self.shared += 1
+                return self.inflight[key]
+            self.misses += 1
+            fut = self.inflight[key] = Future()
+        try:
+            submit(fut)
+        except BaseException as e:
+            with self.lock:
+                self.inflight.pop(key,None)
+            fut._set_exception(e)
+            raise
+        fut.add_done_callback(functools.partial(self._done,key))
+        return fut
+
+    def _done(self,key,fut):
+        with self.lock:
+            self.inflight.pop(key,None)
+            if self.maxsize <= 0 or fut.cancelled() or fut._exception is not None:
+                return
+            expire = None if self.ttl is None else time.monotonic() + self.ttl
+            self.results[key] = (fut, expire)
+            self.results.move_to_end(key)
+            while len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+                self.evictions += 1
+
+    def info(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "inflight_hits": self.shared,
+                    "evictions": self.evictions, "currsize": len(self.results),
+                    "inflight": len(self.inflight)}
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+
+def _isawaitable(obj):
+    # 和 inspect.isawaitable 的判断一致，只是为了不导入 inspect
+    if isinstance(obj,types.CoroutineType):
+        return True
+    if isinstance(obj,types.GeneratorType):
+        return bool(obj.gi_code.co_flags & 0x100) # CO_ITERABLE_COROUTINE
+    return isinstance(obj,collections.abc.Awaitable)
+
+
+class _AsyncWorker:
+    '''
+    #==============================================================
+    # 协程模式下每组共用一个事件循环线程和一个转发线程
+    # 转发线程从队列取出任务，拿到一个并发名额后丢进事件循环执行
+    # 并发名额的数量就是该组的“线程数量”，停止标记会永久收回一个名额
+    # 名额全部收回时（此时所有任务都已执行完毕）关闭事件循环
+    #==============================================================
+    '''
+    def __init__(self,pool,gqueue):
+        self.pool   = pool
+        self.gqueue = gqueue
+        self.live   = 0
+        self.lock   = Lock()
+        self.slots  = Semaphore(0)
+        self.stats  = pool._new_stats(gqueue)
+        import asyncio
+        self.loop   = asyncio.new_event_loop()
+        Thread(target=self._loop_run,daemon=True).start()
+        Thread(target=self._bridge,daemon=True).start()
+
+    def _name(self):
+        ct = current_thread()
+        ct.setName("{}_{}".format(ct.getName(), self.gqueue))
+
+    def _loop_run(self):
+        # 协程模式下整组只有一个事件循环线程，initializer 只执行一次
+        import asyncio
+        self._name()
+        asyncio.set_event_loop(self.loop)
+        init = self.pool._pool_init.get(self.gqueue)
+        _worker_init(init)
+        try:
+            self.loop.run_forever()
+        finally:
+            _worker_final(init)
+            self.loop.close()
+
+    def add(self,num):
+        with self.lock:
+            if self.live < 0: return False # 已经关闭
+            self.live += num
+        for _ in range(num): self.slots.release()
+        return True
+
+    def _bridge(self):
+        self._name()
+        q = self.pool._pool_queue[self.gqueue]
+        while True:
+            v = q.get()
+            self.slots.acquire()
+            if v == KillThreadParams:
+                with self.lock:
+                    self.live -= 1
+                    if self.live: continue
+                    self.live = -1
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.pool._retire_stats(self.gqueue,self.stats)
+                return
+            limiter = self.pool._pool_limiter.get(self.gqueue)
+            if limiter is not None:
+                limiter.acquire()
+            self.loop.call_soon_threadsafe(self.loop.create_task,self._execute(limiter,v))
+
+    async def _execute(self,limiter,task):
+        func, args, kw, fut, t = task.func, task.args, task.kw or {}, task.fut, task.t
+        start = time.perf_counter()
+        state = 2
+        probe = ctx = None
+        token = fut._token
+        deadline = None if token is None else token.deadline
+        try:
+            if deadline is not None and time.monotonic() >= deadline:
+                if fut._set_exception(TimeoutError("task expired before it started.")):
+                    state = 3
+            elif fut._set_running():
+                _current_future.set(fut)
+                probe = _probe
+                if probe is not None:
+                    ctx = probe.start(self.gqueue,func,args,kw,start - t,None)
+                ret = func(*args,**kw)
+                if _isawaitable(ret):
+                    if deadline is None:
+                        ret = await ret
+                    else:
+                        # 协程可以真正地被取消，超时直接取消掉
+                        import asyncio
+                        try:
+                            ret = await asyncio.wait_for(ret,max(deadline - time.monotonic(),0))
+                        except asyncio.TimeoutError:
+                            token.cancel()
+                            state = 4
+                            err = TimeoutError("task timed out while running.")
+                            if ctx is not None:
+                                ctx = probe.finish(ctx,self.gqueue,func,start - t,time.perf_counter() - start,err)
+                            fut._set_exception(err)
+                            return
+                # 先记录慢任务、执行钩子，再唤醒等待结果的协程
+                if ctx is not None:
+                    ctx = probe.finish(ctx,self.gqueue,func,start - t,time.perf_counter() - start,None)
+                fut._set_result(ret)
+                state = 0
+        except BaseException as e:
+            if ctx is not None:
+                ctx = probe.finish(ctx,self.gqueue,func,start - t,time.perf_counter() - start,e)
+            if fut._cancelled_by_token(e):
+                state = 2
+                fut._finish(_CANCELLED)
+            elif self.pool._retry(self.gqueue,task,e):
+                state = 5
+            else:
+                state = 1
+                if log_flag._elog:
+                    print(traceback.format_exc())
+                if fut._set_exception(e):
+                    self.pool._dead_letter(self.gqueue,func,args,kw,e)
+        finally:
+            run = time.perf_counter() - start
+            self.stats.record(start - t, run, state)
+            if limiter is not None:
+                # 排队超时被丢弃的任务没有执行，令牌还回去
+                if state == 3: limiter._refund()
+                else:          limiter.release()
+            if state != 5:
+                self.pool._monitor_run_num[self.gqueue].decr()
+            self.slots.release()
+
+
+def as_completed(fs,timeout=None):
+    '''
+    #==============================================================
+    # 按照完成的先后顺序迭代一组 Future
+    # timeout 为整体的超时时间，超时后抛出 TimeoutError
+    #==============================================================
+    '''
+    fs = set(fs)
+    end = None if timeout is None else time.time() + timeout
+    done = queue.Queue()
+    for f in fs:
+        f.add_done_callback(done.put)
+    for i in range(len(fs)):
+        try:
+            yield done.get(timeout=_remaining(end))
+        except queue.Empty:
+            raise TimeoutError("{} (of {}) futures unfinished".format(len(fs)-i, len(fs)))
+
 class pool:
     '''
     #==============================================================
@@ -231,56 +1641,246 @@ class pool:
     #==============================================================
     '''
 
-    _monitor = None       # 监视主线程是否在运行的线程
-    _monitor_run_num = {} # 用判断队列是否为空监视线程是否执行完毕
+    _monitor = None       # 进程退出时的收尾函数，"lazy"/"drain" 为第一次启动伺服线程时再注册
+    exit_timeout = None   # 进程退出时超过这么多秒没有任何任务执行完毕就不再等待，默认 None 为一直等到执行完毕
+    _monitor_run_num = {} # 每组未执行完毕的任务计数，用于判断线程是否执行完毕
     
     # 默认0号作为全局函数队列
     _pool_queue = {}
     _pool_func_num = {}
+    _pool_put_policy = {} # 每组队列满时的提交策略 (block, timeout)
+    _pool_backend = {}    # 每组的执行方式 'thread' 'asyncio' 或 ('process', mp_context)
+    _pool_aio = {}        # 协程模式的组使用的 _AsyncWorker
+    _pool_idle = {}       # 每组正在等待任务的伺服线程计数
+    _pool_autoscale = {}  # 自动伸缩的组的配置 (min, max, keepalive)
+    _pool_lock = RLock()  # 修改线程数量时使用的锁
+    _pool_stats = {}      # 每组的统计数据，第一个元素是已退出线程的数据汇总
+    _pool_steal = {}      # 工作窃取模式的组，记录该组每个伺服线程自己的任务队列
+    _pool_limiter = {}    # 每组使用的 RateLimiter
+    _pool_timeout = {}    # 每组任务默认的超时时间
+    _pool_retry = {}      # 每组的重试策略 (retries, backoff, retry_on)
+    _pool_dead_letter = {} # 每组重试耗尽的任务，deque 或者用户传入的函数
+    _pool_delayed = {}    # 每组等待重试的任务 {_Task: 定时器的 entry}，关闭时一起取消
+    _pool_init = {}       # 每组伺服线程的 (initializer, finalizer)
+    _pool_pending = {}    # 每组已经设置了但还没有启动的伺服线程数量
 
-    def __init__(self,pool_num=None,gqueue='v',log=True,monitor=True):
+    def __init__(self,pool_num=None,gqueue='v',log=True,monitor=True,
+                 maxsize=None,on_full=None,put_timeout=None,
+                 backend=None,mp_context=None,
+                 autoscale=None,keepalive=60,priority=False,scheduler=None,
+                 rate=None,burst=None,dedupe=False,cache_size=0,cache_ttl=None,
+                 timeout=None,retries=None,backoff=0,retry_on=Exception,dead_letter=None,
+                 weight=None,initializer=None,finalizer=None,
+                 slow_threshold=None,profile=None):
         '''
         #==============================================================
         # **kw
-        #     :pool_num  伺服线程数量
-        #     :gqueue    全局队列表的index，默认0，建议用数字标识
-        #     :log       print函数的输出时是否加入线程名作前缀
+        #     :pool_num     伺服线程数量，提交任务时按需启动，最多启动到这个数量
+        #     :gqueue       全局队列表的index，默认0，建议用数字标识
+        #     :log          print函数的输出时是否加入线程名作前缀
+        #     :maxsize      该组队列的最大长度，默认不限制
+        #     :on_full      队列满时提交任务的处理方式，默认 'block'
+        #                   'block'   一直阻塞到队列有空位
+        #                   'timeout' 最多阻塞 put_timeout 秒，超时抛出 queue.Full
+        #                   'reject'  不阻塞，直接抛出 queue.Full
+        #     :put_timeout  on_full='timeout' 时的最长阻塞时间
+        #                   只设置 put_timeout 时 on_full 默认为 'timeout'
+        #     :backend      'thread'(默认) 'process' 或 'asyncio'，组创建后不可修改
+        #                   'process' 时每个伺服线程独占一个子进程执行函数
+        #                   'asyncio' 时整组共用一个事件循环执行协程函数
+        #                   此时 pool_num 代表同时执行的协程数量
+        #     :mp_context   backend='process' 时使用的 multiprocessing 上下文
+        #                   默认为 forkserver（不支持时为 spawn），子进程不从伺服线程 fork
+        #                   避免继承其他线程正持有的锁（比如 print 的锁）
+        #     :autoscale    (min, max) 自动伸缩线程数量，此时忽略 pool_num
+        #                   提交任务时排队的任务比空闲线程多就增加一个线程，最多 max 个
+        #                   线程空闲超过 keepalive 秒就退出，最少保留 min 个
+        #     :keepalive    自动伸缩时空闲线程的存活时间，默认 60 秒
+        #     :priority     该组是否使用优先级队列，组创建后不可修改
+        #                   每次调用默认优先级为 0，数字越小越先执行
+        #                   单次调用可以用 foolfunc.options(priority=-1)(*args) 指定
+        #     :scheduler    'fifo'(默认) 'steal' 或 'fair'，组创建后不可修改
+        #                   'steal' 时每个伺服线程有一个自己的任务队列
+        #                   伺服线程内提交到同组的任务放进自己的队列，不争抢全局队列的锁
+        #                   空闲的线程会从其他线程的队列中窃取任务
+        #                   'fair' 时同组的每个被装饰的函数有一个自己的子队列
+        #                   按照 weight 轮流执行，一个函数提交大量任务不会让其他函数一直排队
+        #     :weight       公平调度模式下这个装饰器装饰的函数的权重，默认为 1
+        #                   权重为 2 的函数得到的执行机会是权重为 1 的两倍
+        #     :initializer  每个伺服线程启动时执行一次的函数，返回值为该线程的资源
+        #                   任务中用 vthread.worker_resource() 获取，例如 requests.Session
+        #                   进程池模式下在子进程中执行，协程模式下整组只执行一次
+        #     :finalizer    伺服线程退出时执行一次的函数，参数为该线程的资源
+        #                   停止标记、change_thread_num、自动伸缩和超时退出时都会执行
+        #                   修改后只对之后启动的伺服线程生效
+        #     :slow_threshold  执行超过这个秒数的任务记录下参数和执行到阈值时的堆栈
+        #                   用 vthread.pool.slow_tasks(gqueue) 查看，每组保留最近的 100 个
+        #     :profile      每 N 次调用用 cProfile 分析一次这个装饰器装饰的函数
+        #                   用 vthread.pool.profile_stats(func) 获取汇总的 pstats.Stats
+        #                   进程池和协程模式下不做分析
+        #     :rate         限制该组每秒开始执行的任务数量，默认不限制
+        #                   可以是数字、'100/s' 格式的字符串或者 vthread.RateLimiter 对象
+        #                   传入同一个 RateLimiter 对象的多个组共用一个限速
+        #     :burst        令牌桶的容量，即最多可以突发执行的任务数量，默认为 1
+        #     :dedupe       参数相同并且还没执行完的调用只执行一次，共用同一个 Future
+        #     :cache_size   大于 0 时把正常结束的结果按参数缓存起来（LRU），同时打开 dedupe
+        #     :cache_ttl    缓存结果的有效时间（秒），默认不过期
+        #                   dedupe 和 cache 只对这个装饰器对象装饰的函数生效，每个函数各自缓存
+        #                   可以用 foolfunc.cache_info() 查看命中情况，foolfunc.cache_clear() 清空
+        #     :timeout      该组任务默认的超时时间（秒），从提交时开始计算，默认不限时
+        #                   单次调用可以用 foolfunc.options(timeout=5)(*args) 指定
+        #                   timeout=float('inf') 则这次调用不限时
+        #                   排队时已经超时的任务直接丢弃，Future 抛出 TimeoutError
+        #                   执行超时的任务 Future 抛出 TimeoutError，并开启一个替代的伺服线程
+        #                   超时的线程执行完这个任务后退出，任务内可以用 vthread.cancel_token() 检查
+        #     :retries      任务抛出异常时最多重试的次数，默认不重试
+        #                   重试的任务放回队列尾部，从提交到最终结束之间 wait 都会等待它
+        #     :backoff      重试前等待的秒数，第 n 次重试等待 backoff * 2 ** (n-1) 秒
+        #                   也可以是函数 backoff(n) 返回等待的秒数
+        #                   等待期间任务放在定时器中，不占用伺服线程
+        #     :retry_on     需要重试的异常类型，可以是元组，默认 Exception
+        #     :dead_letter  重试耗尽后仍然失败的任务记录为 (func,args,kw,exception)
+        #                   默认保存最近的 1000 个，用 vthread.pool.dead_letters(gqueue) 查看
+        #                   也可以是数字指定保存的数量，或者函数 dead_letter(func,args,kw,exception)
+        #                   设置了 retries 或者 dead_letter 的组才会记录
+        #
+        # 和线程数量一样，maxsize 和 on_full 也是以最后一个主动设置的为准
         #==============================================================
         '''
 
+        # 先检查所有的参数，全部通过之后才修改类属性
+        # 否则抛出异常时会留下一半的配置，之后同名的组会在错误的配置上创建
+        if backend not in (None,'thread','process','asyncio'):
+            raise ValueError("backend must be 'thread', 'process' or 'asyncio'.")
+        if gqueue in self._pool_backend:
+            if backend is not None and backend != self._backend_name(gqueue):
+                raise ValueError("gqueue {!r} already use backend {!r}.".format(gqueue,self._backend_name(gqueue)))
+            aio = self._backend_name(gqueue) == 'asyncio'
+        else:
+            aio = backend == 'asyncio'
+        if scheduler not in (None,'fifo','steal','fair'):
+            raise ValueError("scheduler must be 'fifo', 'steal' or 'fair'.")
+        if gqueue not in self._pool_queue:
+            if priority and scheduler == 'fair':
+                raise ValueError("scheduler='fair' can not be used with priority.")
+            if scheduler == 'steal' and (priority or aio):
+                raise ValueError("scheduler='steal' can not be used with priority or asyncio backend.")
+            fair = scheduler == 'fair'
+        else:
+            if priority and not isinstance(self._pool_queue[gqueue],_PriorityQueue):
+                raise ValueError("gqueue {!r} already created without priority.".format(gqueue))
+            if scheduler is not None and scheduler != self._scheduler_name(gqueue):
+                raise ValueError("gqueue {!r} already created with another scheduler.".format(gqueue))
+            fair = isinstance(self._pool_queue[gqueue],_FairQueue)
+        if weight is not None and not fair:
+            raise ValueError("weight only works with scheduler='fair'.")
+        if weight is not None and not weight > 0:
+            raise ValueError("weight must be greater than 0.")
+        if profile is not None and not (isinstance(profile,int) and profile > 0):
+            raise ValueError("profile must be a positive integer.")
+        if (retries is not None or dead_letter is not None) and not (callable(backoff) or backoff >= 0):
+            raise ValueError("backoff must be a non-negative number or a function.")
+        if autoscale is not None:
+            minnum, maxnum = autoscale
+            if not 0 <= minnum <= maxnum or maxnum < 1:
+                raise ValueError("autoscale must be (min, max) with 0 <= min <= max and max >= 1.")
+            if aio:
+                raise ValueError("autoscale is not supported by the asyncio backend.")
+        # 有界队列的提交策略，生产者过快时由此实现背压
+        if on_full is None and put_timeout is not None:
+            on_full = 'timeout'
+        put_policy = None if on_full is None else self._put_policy(on_full,put_timeout)
+
         # 让配置在 toggle 函数执行后的装饰行为都变成只能手动配置 log_flag
         if log_flag._decorator_toggle:
             log_flag._vlog = log
 
+        # 调用缓存是每个被装饰的函数各自一份，所以只记录配置
+        self._cache = (cache_size,cache_ttl) if dedupe or cache_size else None
+
+        # 执行方式在组创建时确定，之后不能再修改
+        if gqueue not in self._pool_backend:
+            if backend == 'process':
+                import multiprocessing
+                if mp_context is None:
+                    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                    mp_context = multiprocessing.get_context(method)
+                backend = ('process', mp_context)
+            self._pool_backend[gqueue] = backend or 'thread'
+
         # 默认用的是全局队列
         if gqueue not in self._pool_queue:
-            self._pool_queue[gqueue] = queue.Queue()
+            if priority:              q = _PriorityQueue()
+            elif scheduler == 'fair': q = _FairQueue()
+            else:                     q = queue.Queue()
+            self._pool_queue[gqueue] = q
+            if scheduler == 'steal':
+                self._pool_steal[gqueue] = []
         self._pool = self._pool_queue[gqueue]
-        
-        # 默认将 print 函数进行monkey patch
-        patch_print()
+        self._weight = weight or 1
+        if maxsize is not None:
+            self._pool.maxsize = maxsize
 
-        # 新线程，监视主线程执行情况，一旦停止就向线程队列注入相应数量的停止标记
-        # 因为该线程池的原理就是让主线程变成派发函数的进程，执行到尾部自然就代表
-        # 分配的任务已经分配完了，这时就可以注入停止标记让线程执行完就赶紧结束掉
-        # 防止在命令行下控制权不交还的情况。
-        if monitor and not self._monitor:
-            self.main_monitor()
-        else:
-            self._monitor = "close"
+        # 限速器和超时时间同样以最后一个主动设置的为准
+        if timeout is not None:
+            self._pool_timeout[gqueue] = timeout
+        if initializer is not None or finalizer is not None:
+            self._pool_init[gqueue] = (initializer,finalizer)
+        if slow_threshold is not None:
+            probe = _get_probe()
+            with probe.lock:
+                probe.slow[gqueue] = slow_threshold
+        self._profile = profile
+        if retries is not None or dead_letter is not None:
+            self._pool_retry[gqueue] = (retries or 0, backoff, retry_on)
+            if callable(dead_letter):
+                self._pool_dead_letter[gqueue] = dead_letter
+            elif dead_letter is not None or gqueue not in self._pool_dead_letter:
+                self._pool_dead_letter[gqueue] = collections.deque(maxlen=dead_letter or 1000)
+        if isinstance(rate,RateLimiter):
+            self._pool_limiter[gqueue] = rate
+        elif rate is not None:
+            self._pool_limiter[gqueue] = RateLimiter(rate,burst or 1)
 
-        # 在函数执行前put进该组队列，在函数执行完毕后get该组队列
+        if put_policy is not None:
+            self._pool_put_policy[gqueue] = put_policy
+        elif gqueue not in self._pool_put_policy:
+            self._pool_put_policy[gqueue] = (True,None)
+        self._gqueue = gqueue
+
+        # 装饰时只记录配置，不启动线程，也不修改全局的状态
+        # print 函数的 monkey patch 和进程退出时的收尾函数都在第一次启动伺服线程时才执行
+        # 以第一个装饰器的 monitor 参数为准，monitor=False 时退出前只等待任务执行完毕，不关闭伺服线程
+        if pool._monitor is None:
+            pool._monitor = "lazy" if monitor else "drain"
+
+        # 在函数提交时计数加一，在函数执行完毕后计数减一
         # 对每组函数分配进行管理，实现函数执行完毕的挂钩
         if gqueue not in self._monitor_run_num:
-            self._monitor_run_num[gqueue] = queue.Queue()
+            self._monitor_run_num[gqueue] = _RunCounter()
+            self._pool_idle[gqueue] = _RunCounter()
+            self._pool_stats[gqueue] = [_WorkerStats()]
+
+        # 自动伸缩的组以 min 作为初始线程数量，已经存在的组则把线程数量限制在范围内
+        if autoscale is not None:
+            minnum, maxnum = autoscale
+            self._pool_autoscale[gqueue] = (minnum, maxnum, keepalive)
+            if gqueue not in self._pool_func_num:
+                self._pool_func_num[gqueue] = minnum
+                self._add_workers(minnum,gqueue)
+            else:
+                curr = self._pool_func_num[gqueue]
+                self.change_thread_num(min(max(curr,minnum),maxnum),gqueue)
+            return
 
         # 智能选择线程数量
         num = self._auto_pool_num(pool_num)
 
         # 这里考虑的是控制伺服线程数量，相同的gqueue以最后一个人为定义的线程池数为基准
+        # 伺服线程在提交任务时才按需启动，最多启动到设置的数量
         if gqueue not in self._pool_func_num:
             self._pool_func_num[gqueue] = num
-            self._run(num,gqueue)
+            self._add_workers(num,gqueue)
         else:
             # 是以最后一个主动设置的线程池数为基准
             # 所以要排除不设置的情况
@@ -294,12 +1894,177 @@ class pool:
         #==============================================================
         '''
         orig_func[func.__name__] = func
+        gqueue = self._gqueue
+        if isinstance(self._pool,_FairQueue):
+            with self._pool.mutex:
+                self._pool.weights[func] = self._weight
+        if self._profile:
+            probe = _get_probe()
+            with probe.lock:
+                probe.profile[func] = [self._profile,0,None]
+        if self._cache is None:
+            def submit(args,kw,**opts):
+                return self._submit(gqueue,func,args,kw,**opts)
+        else:
+            cache = _CallCache(*self._cache)
+            def submit(args,kw,**opts):
+                return cache.call(args,kw,lambda fut:self._submit(gqueue,func,args,kw,_future=fut,**opts))
         @functools.wraps(func)
         def _run_threads(*args,**kw):
-            # 将函数以及参数包装进 queue
-            self._pool.put((func,args,kw))
+            # 将函数以及参数包装进 queue，返回一个用于获取结果的 Future
+            return submit(args,kw)
+        def options(**opts):
+            # 指定单次调用的额外参数，例如 foolfunc.options(priority=-1,timeout=5)(123)
+            return lambda *args,**kw: submit(args,kw,**opts)
+        _run_threads.options = options
+        if self._cache is not None:
+            _run_threads.cache_info  = cache.info
+            _run_threads.cache_clear = cache.clear
+        # 批量提交的入口，foolfunc.map(range(100)) 等同于 pool.map(foolfunc, range(100))
+        _run_threads.map = functools.partial(self.map,func)
+        _run_threads._vthread_func = func
         return _run_threads
 
+    def map(self,func,*iterables,chunksize=1):
+        '''
+        #==============================================================
+        # 批量提交任务，用法和内建的 map 函数一致
+        #
+        # >>> import vthread
+        # >>>
+        # >>> @vthread.pool(4)
+        # ... def foolfunc(num):
+        # ...     return num * 2
+        # >>>
+        # >>> for i in foolfunc.map(range(10000000), chunksize=1000):
+        # ...     pass # 按照参数的顺序获取结果
+        # >>>
+        # >>> # 也可以直接用装饰器对象执行普通函数
+        # >>> pool = vthread.pool(4, gqueue='m')
+        # >>> list(pool.map(pow, [1,2,3], [2,2,2]))
+        # [1, 4, 9]
+        # >>>
+        #==============================================================
+        # 每 chunksize 个参数打包成一个任务入队，伺服线程一次出队执行一整块
+        # 同时最多只有 2 倍线程数量的块在队列中，消费一块才会再提交一块
+        # 所以即便是千万级别的参数，内存占用也是固定的
+        # 返回的迭代器被提前关闭时，还在排队的块会被取消
+        #==============================================================
+        '''
+        if chunksize < 1:
+            raise ValueError("chunksize must be >= 1")
+        func  = getattr(func,'_vthread_func',func)
+        gqueue = self._gqueue
+        args  = zip(*iterables)
+        chunks = iter(lambda:list(itertools.islice(args,chunksize)),[])
+        window = max(self._pool_func_num.get(gqueue) or 1,1) * 2
+        pending = collections.deque()
+        for chunk in itertools.islice(chunks,window):
+            pending.append(self._submit(gqueue,_run_chunk,(func,chunk),None))
+        def _results():
+            try:
+                while pending:
+                    fut = pending.popleft()
+                    for chunk in itertools.islice(chunks,1):
+                        pending.append(self._submit(gqueue,_run_chunk,(func,chunk),None))
+                    yield from fut.result()
+            finally:
+                for fut in pending: fut.cancel()
+        return _results()
+
+    @staticmethod
+    def _put_policy(on_full,put_timeout):
+        if on_full == 'block':   return (True,None)
+        if on_full == 'reject':  return (False,None)
+        if on_full == 'timeout':
+            if put_timeout is None:
+                raise ValueError("on_full='timeout' need a put_timeout.")
+            return (True,put_timeout)
+        raise ValueError("on_full must be one of 'block', 'timeout', 'reject'.")
+
+    @classmethod
+    def _submit(self,gqueue,func,args,kw,priority=0,timeout=None,_future=None):
+        '''
+        #==============================================================
+        # 向对应组的队列提交一个任务，返回该任务的 Future
+        # priority 只在优先级模式的组中生效
+        # timeout 不指定时使用该组的超时时间，float('inf') 为这次调用不限时
+        #==============================================================
+        '''
+        fut = Future() if _future is None else _future
+        if _probe is not None:
+            _probe.emit('submit',gqueue,func,None,None)
+        if timeout is None:
+            timeout = self._pool_timeout.get(gqueue)
+        if timeout is not None and timeout < math.inf:
+            fut._token = CancelToken(time.monotonic() + timeout)
+        counter = self._monitor_run_num[gqueue]
+        if gqueue in self._pool_steal and getattr(_worker_local,'gqueue',None) == gqueue:
+            # 工作窃取模式下同组伺服线程内提交的任务直接放进自己的队列
+            counter.incr()
+            _worker_local.deque.append(_Task(func,args,kw,fut,priority))
+            if self._pool_idle[gqueue].num():
+                try:
+                    self._pool_queue[gqueue].put_nowait(_WakeUp)
+                except queue.Full:
+                    pass # 队列不为空，不需要额外唤醒
+            elif self._pool_pending.get(gqueue):
+                # 没有空闲的线程时启动一个新的线程来窃取
+                self._grow(gqueue,len(_worker_local.deque))
+            return fut
+        block, timeout = self._pool_put_policy[gqueue]
+        # 先计数再入队，保证任务从提交到执行完毕之间 check_stop 都不会误判
+        # 有界队列满了的时候按该组的策略阻塞或者抛出 queue.Full
+        counter.incr()
+        try:
+            self._pool_queue[gqueue].put(_Task(func,args,kw,fut,priority),block,timeout)
+        except BaseException:
+            counter.decr()
+            raise
+        if self._pool_pending.get(gqueue) or gqueue in self._pool_autoscale:
+            self._grow(gqueue)
+        return fut
+
+    @classmethod
+    def _grow(self,gqueue,backlog=None):
+        # 排队的任务比空闲的线程多时启动一个伺服线程
+        # 先启动设置了但还没有启动的线程，自动伸缩的组没有达到上限时再增加一个
+        if backlog is None:
+            backlog = self._pool_queue[gqueue].qsize()
+        if self._pool_idle[gqueue].num() >= backlog:
+            return
+        with self._pool_lock:
+            pending = self._pool_pending.get(gqueue,0)
+            if pending:
+                # 协程模式只是增加并发名额，一次全部启动
+                n = pending if self._backend_name(gqueue) == 'asyncio' else 1
+                self._pool_pending[gqueue] = pending - n
+                self._run(n,gqueue)
+            elif gqueue in self._pool_autoscale \
+                and self._pool_func_num[gqueue] < self._pool_autoscale[gqueue][1]:
+                self._pool_func_num[gqueue] += 1
+                self._run(1,gqueue)
+
+    @classmethod
+    def _add_workers(self,num,gqueue):
+        # 只记录需要增加的伺服线程数量，提交任务时再启动
+        # 队列中已经有任务在等待时直接启动
+        with self._pool_lock:
+            self._pool_pending[gqueue] = self._pool_pending.get(gqueue,0) + num
+        idle, q = self._pool_idle[gqueue], self._pool_queue[gqueue]
+        while self._pool_pending.get(gqueue) and idle.num() < q.qsize():
+            self._grow(gqueue)
+
+    @classmethod
+    def _scale_down(self,gqueue):
+        # 空闲超时的线程是否可以退出，队列中还有任务（包括停止标记）时不退出
+        with self._pool_lock:
+            if self._pool_func_num[gqueue] > self._pool_autoscale[gqueue][0] \
+                and self._pool_queue[gqueue].empty():
+                self._pool_func_num[gqueue] -= 1
+                return True
+        return False
+
     @classmethod
     def change_thread_num(self,num,gqueue='v'):
         '''
@@ -312,16 +2077,35 @@ class pool:
         # 也是在设计初对任务执行完整性的一种考虑
         #==============================================================
         '''
-        if gqueue in self._pool_func_num:
-            x = self._pool_func_num[gqueue] - num
-            # 当前线程数少于最后一次定义的数量时候会增加伺服线程
-            # 多了则会杀掉多余线程
-            if x < 0:
-                self._run(abs(x),gqueue)
-            if x > 0:
-                for _ in range(abs(x)):
-                    self._pool_queue[gqueue].put(KillThreadParams)
-            self._pool_func_num[gqueue] = num
+        # 自动伸缩的组也可以用这个函数临时修改线程数量，之后仍会自动伸缩
+        kill = 0
+        with self._pool_lock:
+            if gqueue in self._pool_func_num:
+                x = self._pool_func_num[gqueue] - num
+                # 当前线程数少于最后一次定义的数量时候会增加伺服线程
+                # 多了则会杀掉多余线程，还没有启动的线程直接不再启动
+                if x < 0:
+                    self._add_workers(abs(x),gqueue)
+                if x > 0:
+                    pending = self._pool_pending.get(gqueue,0)
+                    self._pool_pending[gqueue] = max(pending - x,0)
+                    kill = x - min(pending,x)
+                self._pool_func_num[gqueue] = num
+        # 停止标记在锁外注入，并且不受队列长度上限的限制
+        # 否则有界队列满了会一直阻塞，关闭线程池和进程退出都会卡住
+        for _ in range(kill):
+            self._force_put(gqueue,KillThreadParams)
+
+    @classmethod
+    def _scheduler_name(self,gqueue):
+        if gqueue in self._pool_steal: return 'steal'
+        if isinstance(self._pool_queue.get(gqueue),_FairQueue): return 'fair'
+        return 'fifo'
+
+    @classmethod
+    def _backend_name(self,gqueue):
+        backend = self._pool_backend.get(gqueue,'thread')
+        return backend if isinstance(backend,str) else backend[0]
 
     @classmethod
     def _run(self,num,gqueue):
@@ -329,59 +2113,507 @@ class pool:
         #==============================================================
         # 运行伺服线程，不指定数量则默认以 cpu 核心数作为伺服线程数量
         # 每个线程都等待任意函数放进队列，然后被线程抓出然后执行
+        # 进程池模式下伺服线程只负责把函数转交给自己的子进程执行
         #==============================================================
         '''
+        # 第一次启动伺服线程时才对 print 打补丁、注册进程退出时的收尾函数
+        patch_print()
+        if pool._monitor in ("lazy","drain"):
+            with self._pool_lock:
+                self.main_monitor()
+        backend = self._pool_backend.get(gqueue,'thread')
+        if backend == 'asyncio':
+            # 协程模式只是增加并发名额，事件循环关闭了就重新开一个
+            worker = self._pool_aio.get(gqueue)
+            if worker is None or not worker.add(num):
+                self._pool_aio[gqueue] = worker = _AsyncWorker(self,gqueue)
+                worker.add(num)
+            return
         # 伺服函数
         def _pools_pull():
+            counter = self._monitor_run_num[gqueue]
+            idle = self._pool_idle[gqueue]
+            q = self._pool_queue[gqueue]
             ct = current_thread()
             name = ct.getName()
             ct.setName("{}_{}".format(name, gqueue))
+            init = self._pool_init.get(gqueue)
+            if backend == 'thread':
+                worker = None
+                _worker_init(init)
+            else:
+                worker = _ProcessWorker(backend[1],init)
+            stats = self._new_stats(gqueue)
+            # 工作窃取模式下每个线程有一个自己的任务队列
+            # 自己的任务从尾部取（后进先出），窃取别人的任务从头部取
+            steal = self._pool_steal.get(gqueue)
+            local = None
+            if steal is not None:
+                local = collections.deque()
+                steal.append(local)
+                _worker_local.gqueue = gqueue
+                _worker_local.deque = local
+            try:
+                while True:
+                    limiter = self._pool_limiter.get(gqueue)
+                    held = False
+                    if limiter is not None and (local or q.qsize()):
+                        # 限速的组有任务排队时先等到令牌再取任务，等待时不占用任务，算作空闲
+                        idle.incr()
+                        try:
+                            limiter.acquire()
+                        finally:
+                            idle.decr()
+                        held = True
+                    v = local.pop() if local else None
+                    if v is None and (local is not None or held):
+                        try:
+                            v = q.get_nowait()
+                        except queue.Empty:
+                            pass
+                    if v is None and held:
+                        # 任务被别的线程取走了，令牌还回去，空闲的线程不能占着令牌
+                        limiter._refund()
+                        held = False
+                    if v is None:
+                        # 先标记为空闲再去窃取，这样提交任务的线程一定能看到需要唤醒
+                        idle.incr()
+                        try:
+                            if local is not None:
+                                v = self._steal(steal,local)
+                            if v is None:
+                                scale = self._pool_autoscale.get(gqueue)
+                                v = q.get() if scale is None else q.get(timeout=scale[2])
+                        except queue.Empty:
+                            # 自动伸缩的组空闲超时，线程数量多于 min 时退出
+                            if self._scale_down(gqueue): return
+                            continue
+                        finally:
+                            idle.decr()
+                    if v is _WakeUp or v == KillThreadParams:
+                        if held: limiter._refund()
+                        if v is _WakeUp: continue
+                        return
+                    func, args, kw, fut, t = v.func, v.args, v.kw or {}, v.fut, v.t
+                    token = fut._token
+                    deadline = None if token is None else token.deadline
+                    expired = deadline is not None and time.monotonic() >= deadline
+                    if limiter is not None and not held and not expired:
+                        # 没有提前拿到令牌的任务（比如窃取来的任务）在这里等待令牌
+                        limiter.acquire()
+                        held = True
+                        expired = deadline is not None and time.monotonic() >= deadline
+                    if expired:
+                        # 在队列中等待的时间超过了截止时间，直接丢弃不再执行
+                        if held: limiter._refund()
+                        expired = fut._set_exception(TimeoutError("task expired before it started."))
+                        stats.record(0, 0, 3 if expired else 2)
+                        counter.decr()
+                        continue
+                    start = time.perf_counter()
+                    state = 2
+                    settled = True # 为 False 时说明任务已经被看门狗判定为超时
+                    watchdog = probe = ctx = None
+                    try:
+                        if fut._set_running():
+                            _current_future.set(fut)
+                            if deadline is not None:
+                                watchdog = _timer.schedule(deadline,self._overrun,gqueue,func,fut,worker)
+                            probe = _probe
+                            if probe is not None:
+                                ctx = probe.start(gqueue,func,args,kw,start - t,ct if worker is None else None)
+                            if worker is None:
+                                ret = func(*args,**kw)
+                            else:
+                                ret = worker.call(func,args,kw)
+                            # 先记录慢任务、执行钩子，再唤醒等待结果的线程
+                            if ctx is not None:
+                                ctx = probe.finish(ctx,gqueue,func,start - t,time.perf_counter() - start,None)
+                            settled = fut._set_result(ret)
+                            state = 0
+                    except BaseException as e:
+                        if watchdog is not None:
+                            _timer.cancel(watchdog)
+                        if ctx is not None:
+                            ctx = probe.finish(ctx,gqueue,func,start - t,time.perf_counter() - start,e)
+                        if fut._cancelled_by_token(e):
+                            state = 2
+                            settled = fut._finish(_CANCELLED)
+                        elif self._retry(gqueue,v,e):
+                            state = 5 # 放进定时器等待重试，任务仍然算作未执行完毕
+                        else:
+                            state = 1
+                            if log_flag._elog and not fut.done():
+                                print(traceback.format_exc())
+                            settled = fut._set_exception(e)
+                            if settled:
+                                self._dead_letter(gqueue,func,args,kw,e)
+                    finally:
+                        if watchdog is not None:
+                            _timer.cancel(watchdog)
+                        if held:
+                            limiter.release()
+                        run = time.perf_counter() - start
+                        if settled:
+                            stats.record(start - t, run, state)
+                            if state != 5:
+                                counter.decr() # 标记线程是否执行完毕
+                    if not settled:
+                        # 看门狗已经替这个任务收尾，并开启了替代的伺服线程，这里直接退出
+                        return
+            finally:
+                if local is not None:
+                    steal.remove(local)
+                    _worker_local.gqueue = None
+                    # 超时退出时自己的队列里可能还有任务，放回全局队列
+                    while local:
+                        q.put(local.popleft())
+                if worker is not None:
+                    worker.close()
+                else:
+                    _worker_final(init)
+                self._retire_stats(gqueue,stats)
+        # 线程的开启
+        # 伺服线程都是守护线程，卡住的任务不会导致进程无法退出
+        # 进程退出前由 _exit_drain 负责等待任务执行完毕
+        for _ in range(num): Thread(target=_pools_pull,daemon=True).start()
+
+    @classmethod
+    def _overrun(self,gqueue,func,fut,worker):
+        '''
+        #==============================================================
+        # 看门狗：任务执行超过了截止时间，在定时器线程中执行
+        # 由这里给 Future 设置 TimeoutError 并把任务计数减一，wait 不会被卡住
+        # 卡住的伺服线程无法被强制停止，所以开启一个替代的伺服线程保证可用的线程数量
+        # 卡住的线程执行完这个任务后发现结果已经被设置，就直接退出
+        #==============================================================
+        '''
+        if not fut._finish(_FINISHED,exception=TimeoutError("task timed out while running."),running=True):
+            return # 恰好执行完毕或者正在等待重试
+        fut._token.cancel()
+        self._monitor_run_num[gqueue].decr()
+        with self._pool_lock:
+            self._pool_stats[gqueue][0].timed_out += 1
+            self._run(1,gqueue)
+        if worker is not None:
+            worker.kill() # 子进程中的任务无法协作取消，直接结束子进程
+        if log_flag._elog:
+            print("[vthread] {} in gqueue {!r} timed out, started a replacement worker."
+                  .format(getattr(func,'__qualname__',func),gqueue))
+
+    @classmethod
+    def _retry(self,gqueue,v,e):
+        '''
+        #==============================================================
+        # 任务抛出异常时判断是否需要重试，需要则返回 True
+        # 重试的任务放进定时器，到时间后再放回队列，不会占用伺服线程等待
+        #==============================================================
+        '''
+        policy = self._pool_retry.get(gqueue)
+        if policy is None: return False
+        retries, backoff, retry_on = policy
+        fut = v.fut
+        if fut._attempts >= retries or not isinstance(e,retry_on): return False
+        if not fut._set_pending(): return False # 已经被看门狗判定为超时
+        fut._attempts += 1
+        delay = backoff(fut._attempts) if callable(backoff) else backoff * 2 ** (fut._attempts - 1)
+        # 记录下来，等待期间关闭线程池时可以取消
+        with self._pool_lock:
+            delayed = self._pool_delayed.setdefault(gqueue,{})
+            delayed[v] = _timer.schedule(time.monotonic() + delay,self._requeue,gqueue,v) if delay > 0 else None
+        if delay <= 0:
+            self._requeue(gqueue,v)
+        return True
+
+    @classmethod
+    def _force_put(self,gqueue,v):
+        # 不阻塞地放入队列，有界队列满了也直接放进去
+        q = self._pool_queue[gqueue]
+        with q.mutex:
+            q._put(v)
+            q.unfinished_tasks += 1
+            q.not_empty.notify()
+
+    @classmethod
+    def _requeue(self,gqueue,v):
+        # 重试的任务已经计过数了，直接放回队列尾部
+        # 在定时器线程中执行，不能阻塞，所以有界队列满了也直接放进去
+        with self._pool_lock:
+            delayed = self._pool_delayed.get(gqueue)
+            if not delayed or v not in delayed: return # 已经被 _cancel_pending 取消
+            del delayed[v]
+            closed = not self._pool_func_num.get(gqueue) and gqueue not in self._pool_autoscale
+        if closed:
+            # 等待期间组已经关闭，放回队列也不会再执行，直接取消
+            if v.fut.cancel():
+                with self._pool_lock:
+                    self._pool_stats[gqueue][0].cancelled += 1
+            self._monitor_run_num[gqueue].decr()
+            return
+        self._force_put(gqueue,v)
+        if self._pool_pending.get(gqueue) or gqueue in self._pool_autoscale:
+            self._grow(gqueue)
+
+    @classmethod
+    def _dead_letter(self,gqueue,func,args,kw,e):
+        sink = self._pool_dead_letter.get(gqueue)
+        if sink is None: return
+        if isinstance(sink,collections.deque):
+            sink.append((func,args,kw,e))
+            return
+        try:
+            sink(func,args,kw,e)
+        except BaseException:
+            if log_flag._elog:
+                print(traceback.format_exc())
+
+    @classmethod
+    def add_hook(self,event,fn):
+        '''
+        #==============================================================
+        # 注册任务生命周期的钩子，所有组共用
+        #     :event  'submit' 'start' 'finish' 'error'
+        #     :fn     fn(gqueue, func, wait, run)，error 钩子为 fn(gqueue, func, wait, run, exception)
+        #             wait 为在队列中等待的秒数，run 为执行的秒数，还没有的为 None
+        # 钩子在伺服线程中同步执行，需要尽量轻量，抛出的异常只会被打印
+        #
+        # >>> def on_finish(gqueue, func, wait, run):
+        # ...     metrics.observe(func.__name__, run)
+        # >>> vthread.pool.add_hook('finish', on_finish)
+        #==============================================================
+        '''
+        if event not in _Probe.EVENTS:
+            raise ValueError("event must be one of {}.".format(_Probe.EVENTS))
+        probe = _get_probe()
+        with probe.lock:
+            # 复制一份再替换，伺服线程遍历的时候不需要加锁
+            probe.hooks[event] = probe.hooks[event] + [fn]
+
+    @classmethod
+    def remove_hook(self,event,fn):
+        '''
+        #==============================================================
+        # 移除注册的钩子，全部移除后伺服线程恢复到没有钩子时的开销
+        #==============================================================
+        '''
+        global _probe
+        probe = _probe
+        if probe is None: return
+        with probe.lock:
+            hooks = list(probe.hooks.get(event,()))
+            if fn in hooks:
+                hooks.remove(fn)
+                probe.hooks[event] = hooks
+            if probe.empty():
+                _probe = None
+
+    @classmethod
+    def slow_tasks(self,gqueue='v',clear=False):
+        '''
+        #==============================================================
+        # 查看某组执行时间超过 slow_threshold 的任务，返回字典的列表
+        #     gqueue, func, args, kw, thread, wait, run, error
+        #     stack  执行到阈值时任务所在的堆栈，协程和进程池模式下为 None
+        #==============================================================
+        '''
+        probe = _probe
+        if probe is None: return []
+        with probe.lock:
+            log = probe.slow_log.get(gqueue)
+            ret = list(log or ())
+            if clear and log: log.clear()
+        return ret
+
+    @classmethod
+    def profile_stats(self,func):
+        '''
+        #==============================================================
+        # 获取 profile 参数采样分析的汇总结果（pstats.Stats），还没有采样时返回 None
+        #
+        # >>> @vthread.pool(4, profile=100) # 每 100 次调用分析一次
+        # ... def parse(html): pass
+        # >>> vthread.pool.profile_stats(parse).sort_stats('cumulative').print_stats(20)
+        #==============================================================
+        '''
+        func = getattr(func,'_vthread_func',func)
+        probe = _probe
+        if probe is None: return None
+        p = probe.profile.get(func)
+        return None if p is None else p[2]
+
+    @classmethod
+    def dead_letters(self,gqueue='v',clear=False):
+        '''
+        #==============================================================
+        # 查看某组重试耗尽后仍然失败的任务，返回 (func,args,kw,exception) 的列表
+        # clear=True 时同时清空，可以用来把失败的任务重新提交
+        #
+        # >>> for func,args,kw,e in vthread.pool.dead_letters('v', clear=True):
+        # ...     print(func.__name__, args, repr(e))
+        #==============================================================
+        '''
+        sink = self._pool_dead_letter.get(gqueue)
+        if not isinstance(sink,collections.deque):
+            return []
+        ret = []
+        if clear:
             while True:
-                v = self._pool_queue[gqueue].get()
-                if v == KillThreadParams: return
                 try:
-                    func,args,kw = v
-                    self._monitor_run_num[gqueue].put('V') # 标记线程是否执行完毕
-                    func(*args,**kw)
-                except BaseException as e:
-                    if log_flag._elog:
-                        print(traceback.format_exc())
-                finally:
-                    self._monitor_run_num[gqueue].get('V') # 标记线程是否执行完毕
-        # 线程的开启
-        for _ in range(num): Thread(target=_pools_pull).start()
+                    ret.append(sink.popleft())
+                except IndexError:
+                    break
+            return ret
+        return list(sink)
+
+    @staticmethod
+    def _steal(steal,local):
+        # 从一个随机的位置开始轮询其他线程的队列，窃取最早放进去的任务
+        deques = list(steal)
+        n = len(deques)
+        if n:
+            start = random.randrange(n)
+            for i in range(n):
+                d = deques[(start + i) % n]
+                if d is local: continue
+                try:
+                    return d.popleft()
+                except IndexError:
+                    pass
+        return None
 
     @classmethod
     def main_monitor(self):
         '''
         #==============================================================
-        # 对主线程进行监视的函数
-        # 一旦主线程执行完毕就会向所有线程池函数队列尾注入停止标记
-        # 使所有的线程在执行完任务后都停止下来
-        # 对于命令行使用的 python 脚本尤为重要
-        # 因为如果所有线程不停止的话，控制权就不会交还给命令窗口
+        # 注册进程退出时的收尾函数
+        # 主线程执行完毕后等待所有任务执行完毕，再向所有线程池函数队列尾注入停止标记
+        # 设置了 pool.exit_timeout 时，超过这么多秒没有任何任务执行完毕就不再等待，守护线程随进程一起退出
+        # 默认为 None，和以前一样一直等到任务全部执行完毕
         #
         # 在任意被含有该函数的装饰类装饰的情况下，这个是默认被打开的
         # 可以在装饰时通过设置 monitor 参数是否打开，默认以第一个装饰器设置为准
+        # monitor=False 时同样会等待任务执行完毕，只是不注入停止标记关闭伺服线程
+        #
+        # 以前是开一个 MainMonitor 线程轮询主线程是否结束，现在不再需要额外的线程
+        # 收尾函数在解释器等待非守护线程之前执行，所以缓存线程也能及时退出
+        # 第一次启动伺服线程时才注册，只装饰不调用的函数不会有任何副作用
         #==============================================================
         '''
-        def _func():
+        if pool._monitor not in (None,"lazy","drain"):
+            return
+        close = pool._monitor != "drain"
+        pool._monitor = close
+        try:
+            # 在 threading 等待非守护线程之前执行，和 concurrent.futures 的做法一致
+            threading._register_atexit(self._exit_drain,close)
+        except AttributeError:
+            atexit.register(self._exit_drain,close)
+        except RuntimeError:
+            pass # 解释器已经在退出
+
+    @classmethod
+    def _exit_drain(self,close=True):
+        try:
+            drained = self._exit_wait()
+            if close:
+                self.shutdown(wait=drained,timeout=self.exit_timeout)
+        finally:
+            _thread_cache.close()
+
+    @classmethod
+    def _exit_wait(self):
+        # 等待所有组的任务执行完毕，执行完返回 True
+        # 只要还有任务在陆续执行完就一直等待，超过 exit_timeout 秒没有任何进展才放弃
+        # 没有伺服线程的组中排队的任务永远不会执行，先直接取消
+        for gqueue in list(self._pool_func_num):
+            if not self._pool_func_num.get(gqueue):
+                self._cancel_pending(gqueue)
+        timeout = self.exit_timeout
+        done = sum(c.finished() for c in list(self._monitor_run_num.values()))
+        while not self.waitall(timeout):
+            last, done = done, sum(c.finished() for c in list(self._monitor_run_num.values()))
+            if done == last:
+                if log_flag._elog:
+                    print("[vthread] no task finished in {} seconds at exit, stop waiting.".format(timeout))
+                return False
+        return True
+
+    @classmethod
+    def _cancel_pending(self,gqueue):
+        # 取出该组还在排队的任务全部取消，停止标记放回队列，返回被取消的 (func,args,kw)
+        # 在定时器中等待重试的任务也一起取消
+        q = self._pool_queue[gqueue]
+        items, pills = [], []
+        with self._pool_lock:
+            delayed = self._pool_delayed.pop(gqueue,None) or {}
+        for v,entry in delayed.items():
+            if entry is not None: _timer.cancel(entry)
+            items.append(v)
+        while True:
+            try:
+                v = q.get_nowait()
+            except queue.Empty:
+                break
+            if v is KillThreadParams: pills.append(v)
+            elif v is not _WakeUp:    items.append(v)
+        for d in list(self._pool_steal.get(gqueue,())):
             while True:
-                time.sleep(.25)
-                if not main_thread().isAlive() and all(map(lambda i:i.empty(),self._monitor_run_num.values())):
-                    self.close_all()
+                try:
+                    items.append(d.popleft())
+                except IndexError:
                     break
-        if not self._monitor:
-            self._monitor = Thread(target=_func,name="MainMonitor")
-            self._monitor.start()
+        for v in pills: self._force_put(gqueue,v)
+        cancelled = []
+        counter = self._monitor_run_num[gqueue]
+        for v in items:
+            if v.fut.cancel():
+                cancelled.append((v.func,v.args,v.kw or {}))
+            counter.decr()
+        with self._pool_lock:
+            self._pool_stats[gqueue][0].cancelled += len(cancelled)
+        return cancelled
+
+    @classmethod
+    def shutdown(self,gqueue=None,wait=True,timeout=None,cancel_pending=False):
+        '''
+        #==============================================================
+        # 关闭线程池
+        #     :gqueue          需要关闭的组，None 为关闭所有组
+        #     :wait            是否等待任务执行完毕
+        #     :timeout         最长等待时间，超时后直接返回，剩下的任务仍在后台执行
+        #     :cancel_pending  是否取消还在排队的任务，否则会先执行完排队的任务
+        #                      已经关闭的组（伺服线程数为 0）中排队的任务总是会被取消
+        #                      在定时器中等待重试的任务也算作排队的任务
+        # 返回被取消的任务的 (func,args,kw) 列表
+        #
+        # >>> cancelled = vthread.pool.shutdown(timeout=10, cancel_pending=True)
+        # >>> for func,args,kw in cancelled: ... # 可以记录下来下次再执行
+        #==============================================================
+        '''
+        end = None if timeout is None else time.time() + timeout
+        gqueues = list(self._pool_func_num) if gqueue is None else [gqueue]
+        cancelled = []
+        for i in gqueues:
+            # 已经关闭（没有伺服线程，也没有等待启动的线程）的组中排队的任务永远不会执行
+            # 直接取消，否则等待会一直卡住，进程退出时也一样
+            if cancel_pending or not self._pool_func_num.get(i):
+                cancelled.extend(self._cancel_pending(i))
+        if wait and not cancel_pending:
+            # 先等待任务执行完毕再注入停止标记，因为任务可能会向其他组提交新任务
+            if gqueue is None: self.waitall(_remaining(end))
+            else:              self.wait(gqueue,_remaining(end))
+        for i in gqueues:
+            self.change_thread_num(0,i)
+        if wait:
+            if gqueue is None: self.waitall(_remaining(end))
+            else:              self.wait(gqueue,_remaining(end))
+        return cancelled
 
     @staticmethod
     def _auto_pool_num(num):
         if not num:
-            try:
-                from multiprocessing import cpu_count
-                num = cpu_count()
-            except:
+            num = os.cpu_count()
+            if not num:
                 if log_flag._elog:
                     print("cpu_count error. use default num 4.")
                 num = 4
@@ -425,15 +2657,146 @@ class pool:
         l = len(self._pool_func_num)
         print("threads group number: {}".format(l))
         for i,j in self._pool_func_num.items():
-            print("gqueue:{}, alive threads number:{}".format(i, j))
+            print("gqueue:{}, alive threads number:{}".format(i, j - self._pool_pending.get(i,0)))
 
     @classmethod
-    def waitall(self):
-        while any([not self.check_stop(gqueue) for gqueue in self._monitor_run_num]):
-            time.sleep(.25)
+    def _new_stats(self,gqueue):
+        stats = _WorkerStats()
+        self._pool_stats[gqueue].append(stats)
+        return stats
 
     @classmethod
-    def wait(self, gqueue='v'):
+    def _retire_stats(self,gqueue,stats):
+        # 线程退出时把它的统计数据并入汇总，避免自动伸缩时列表无限增长
+        with self._pool_lock:
+            ls = self._pool_stats[gqueue]
+            ls[0].merge(stats)
+            ls.remove(stats)
+
+    @classmethod
+    def stats(self, gqueue='v'):
+        '''
+        #==============================================================
+        # 获取某组线程池的统计数据
+        #
+        # >>> vthread.pool.stats('v')
+        # {'gqueue': 'v', 'workers': 4, 'busy': 1, 'idle': 3, 'queue_depth': 0,
+        #  'submitted': 10, 'completed': 8, 'failed': 1, 'cancelled': 0,
+        #  'expired': 0, 'timed_out': 0, 'retried': 0, 'dead_letters': 0,
+        #  'queue_wait': {'count': 9, 'sum': 0.0012, 'buckets': [(7.62e-06, 3), ...]},
+        #  'run_time':   {'count': 9, 'sum': 9.0031, 'buckets': [...]}}
+        #
+        # 直方图按 2 的幂次分桶，buckets 为 (上界秒数, 累计数量) 的列表
+        # 每个线程只写自己的统计数据，读取时才合并，不影响任务执行的效率
+        #==============================================================
+        '''
+        total = _WorkerStats()
+        with self._pool_lock:
+            ls = list(self._pool_stats[gqueue])
+        for i in ls: total.merge(i)
+        workers = self._pool_func_num.get(gqueue,0) - self._pool_pending.get(gqueue,0)
+        depth = self._pool_queue[gqueue].qsize()
+        depth += sum(len(d) for d in list(self._pool_steal.get(gqueue,())))
+        inflight = self._monitor_run_num[gqueue].num()
+        if self._backend_name(gqueue) == 'asyncio':
+            busy = max(min(inflight - depth, workers), 0)
+        else:
+            busy = max(workers - self._pool_idle[gqueue].num(), 0)
+        ret = {
+            "gqueue":      gqueue,
+            "workers":     workers,
+            "busy":        busy,
+            "idle":        workers - busy,
+            "queue_depth": depth,
+            "submitted":   self._monitor_run_num[gqueue].submitted(),
+            "completed":   total.completed,
+            "failed":      total.failed,
+            "cancelled":   total.cancelled,
+            "expired":     total.expired,
+            "timed_out":   total.timed_out,
+            "retried":     total.retried,
+            "dead_letters": len(self._pool_dead_letter.get(gqueue) or ()),
+            "queue_wait":  _hist_dict(total.wait_sum,total.wait_hist),
+            "run_time":    _hist_dict(total.run_sum,total.run_hist),
+        }
+        if isinstance(self._pool_queue[gqueue],_FairQueue):
+            ret["flows"] = self._pool_queue[gqueue].depths() # 公平调度模式下每个函数排队的任务数量
+        return ret
+
+    @classmethod
+    def stats_all(self):
+        '''
+        #==============================================================
+        # 获取所有组的统计数据，返回 {gqueue: stats} 的字典
+        #==============================================================
+        '''
+        return {gqueue:self.stats(gqueue) for gqueue in list(self._pool_stats)}
+
+    @classmethod
+    def stats_prometheus(self):
+        '''
+        #==============================================================
+        # 将所有组的统计数据导出为 prometheus 的文本格式
+        # 可以直接作为 /metrics 接口的返回内容
+        #==============================================================
+        '''
+        lines = []
+        def metric(name,kind,doc):
+            lines.append("# HELP vthread_{} {}".format(name,doc))
+            lines.append("# TYPE vthread_{} {}".format(name,kind))
+        def label(gqueue,**kw):
+            kw = ''.join(',{}="{}"'.format(k,v) for k,v in kw.items())
+            return '{{gqueue="{}"{}}}'.format(str(gqueue).replace('\\','\\\\').replace('"','\\"'),kw)
+        allstats = self.stats_all()
+        for name,key,doc in (("tasks_submitted_total","submitted","Tasks submitted."),
+                             ("tasks_completed_total","completed","Tasks finished without error."),
+                             ("tasks_failed_total",   "failed",   "Tasks raised an exception."),
+                             ("tasks_cancelled_total","cancelled","Tasks cancelled."),
+                             ("tasks_expired_total",  "expired",  "Tasks dropped after their deadline passed in the queue."),
+                             ("tasks_timed_out_total","timed_out","Tasks that overran their deadline while running."),
+                             ("tasks_retried_total",  "retried",  "Failed attempts scheduled for a retry.")):
+            metric(name,"counter",doc)
+            for gqueue,st in allstats.items():
+                lines.append("vthread_{}{} {}".format(name,label(gqueue),st[key]))
+        metric("queue_depth","gauge","Tasks waiting in the queue.")
+        for gqueue,st in allstats.items():
+            lines.append("vthread_queue_depth{} {}".format(label(gqueue),st["queue_depth"]))
+        metric("workers","gauge","Workers by state.")
+        for gqueue,st in allstats.items():
+            for state in ("busy","idle"):
+                lines.append("vthread_workers{} {}".format(label(gqueue,state=state),st[state]))
+        for name,key,doc in (("queue_wait_seconds","queue_wait","Time tasks spent in the queue."),
+                             ("run_seconds",       "run_time",  "Time tasks spent running.")):
+            metric(name,"histogram",doc)
+            for gqueue,st in allstats.items():
+                hist = st[key]
+                for le,n in hist["buckets"]:
+                    le = "+Inf" if le == float('inf') else repr(le)
+                    lines.append("vthread_{}_bucket{} {}".format(name,label(gqueue,le=le),n))
+                lines.append("vthread_{}_sum{} {}".format(name,label(gqueue),hist["sum"]))
+                lines.append("vthread_{}_count{} {}".format(name,label(gqueue),hist["count"]))
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def waitall(self, timeout=None):
+        '''
+        #==============================================================
+        # 等待所有组的任务全部结束
+        # 因为某组的任务可能会向其他组提交任务，所以要等到所有组同时为空才返回
+        # 超时返回 False，全部结束返回 True
+        #==============================================================
+        '''
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            counters = list(self._monitor_run_num.values())
+            for counter in counters:
+                if not counter.wait(_remaining(end)):
+                    return False
+            if all(counter.empty() for counter in counters):
+                return True
+
+    @classmethod
+    def wait(self, gqueue='v', timeout=None):
         '''
         #==============================================================
         # 等待任务结束，以下是实例代码
@@ -456,9 +2819,26 @@ class pool:
         # print('ls:{}'.format(ls))
         # print('end')
         #==============================================================
+        # 任务计数归零时会直接唤醒等待的线程，不再是定时轮询
+        # timeout 为最长等待时间，超时返回 False，任务全部结束返回 True
+        #==============================================================
         '''
-        while not self.check_stop(gqueue):
-            time.sleep(.25)
+        return self._monitor_run_num[gqueue].wait(timeout)
+
+    @classmethod
+    async def wait_async(self, gqueue='v', timeout=None):
+        '''
+        #==============================================================
+        # wait 的协程版本，在事件循环中等待某组任务结束而不阻塞事件循环
+        #
+        # >>> async def main():
+        # ...     for i in range(100): foolfunc(i)
+        # ...     await vthread.pool.wait_async()
+        #==============================================================
+        '''
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.wait, gqueue, timeout)
 
     @classmethod
     def check_stop(self, gqueue='v'):
@@ -494,8 +2874,214 @@ class pool:
         # print('end')
         #==============================================================
         '''
-        return not (self._monitor_run_num[gqueue].qsize() or self._pool_queue[gqueue].qsize())
+        # 计数包含了排队中和执行中的任务，所以一次读取就能得到准确的结果
+        return self._monitor_run_num[gqueue].empty()
+
+
+
+class ppool(pool):
+    '''
+    #==============================================================
+    # 进程池的装饰，等同于 vthread.pool(..., backend='process')
+    # 适用于 CPU 密集型的函数，不再受 GIL 的限制
+    #
+    # >>> import vthread
+    # >>>
+    # >>> @vthread.ppool(4) # 开4个子进程，默认组名为 'p'
+    # ... def foolfunc(num):
+    # ...     return sum(i*i for i in range(num))
+    # >>>
+    # >>> if __name__ == '__main__':
+    # ...     fs = [foolfunc(10**6) for _ in range(8)]
+    # ...     print([f.result() for f in fs])
+    # ...     vthread.pool.wait('p')
+    #
+    # 分组、change_thread_num、wait、close_all 的用法都和 pool 一致
+    # 函数、参数和返回值都需要能被 pickle 序列化
+    # 子进程默认以 forkserver 或 spawn 方式启动，会重新导入主模块，所以需要 __main__ 保护
+    #==============================================================
+    '''
+    def __init__(self,pool_num=None,gqueue='p',**kw):
+        kw.setdefault('backend','process')
+        super().__init__(pool_num,gqueue,**kw)
+
+
+class pipeline:
+    '''
+    #==============================================================
+    # 多个线程池首尾相连的流水线，每个阶段是一个有界队列的组
+    # 上一个阶段函数的返回值自动提交给下一个阶段
+    # 返回生成器时每个 yield 出来的值都会提交，返回 None 则不提交
+    # 下一个阶段的队列满了时上一个阶段会阻塞等待，内存占用是固定的
+    #
+    # >>> import vthread
+    # >>>
+    # >>> p = vthread.pipeline(maxsize=100)
+    # >>>
+    # >>> @p.stage(8) # 8个线程下载
+    # ... def crawl(url):
+    # ...     return requests.get(url).text
+    # >>>
+    # >>> @p.stage(2) # 2个线程解析
+    # ... def parse(html):
+    # ...     for item in extract(html):
+    # ...         yield item
+    # >>>
+    # >>> @p.stage(1) # 1个线程保存
+    # ... def save(item):
+    # ...     f.write(item)
+    # >>>
+    # >>> p.run(urls) # 提交完所有数据，并等待所有阶段依次结束
+    # >>> p.stats()   # 每个阶段的统计数据
+    #
+    # 数据源提交完之后，每个阶段在上游全部结束并且自己执行完毕后关闭伺服线程
+    # 所以结束信号会自动一级一级向下传递，不需要轮询 check_stop
+    #==============================================================
+    '''
+    _seq = itertools.count()
 
+    def __init__(self,maxsize=1000,name=None):
+        '''
+        #==============================================================
+        #     :maxsize  每个阶段默认的队列容量，也就是阶段之间通道的大小
+        #     :name     流水线的名字，各个阶段的组名为 "名字.函数名"
+        #==============================================================
+        '''
+        self.name     = name or 'pipeline{}'.format(next(self._seq))
+        self.maxsize  = maxsize
+        self._stages  = [] # 每个阶段的 (gqueue, 提交函数)
+        self._blocked = [] # 每个阶段的 [阻塞总时间, 阻塞次数]，即该阶段的背压
+        self._lock    = Lock()
+        self._start   = None
+        self._closed  = False
+
+    def stage(self,pool_num=None,maxsize=None,gqueue=None,**kw):
+        '''
+        #==============================================================
+        # 添加一个阶段的装饰器，按照装饰的顺序连接
+        #     :pool_num  该阶段的伺服线程数量
+        #     :maxsize   该阶段的队列容量，默认使用流水线的 maxsize
+        #     :gqueue    该阶段使用的组名，默认为 "流水线名字.函数名"
+        #     :**kw      其他参数和 vthread.pool 一致，例如 retries、timeout、rate
+        # 被装饰的函数不会被替换，仍然可以直接调用
+        #==============================================================
+        '''
+        if kw.get('backend') not in (None,'thread'):
+            raise ValueError("pipeline stages only support the thread backend.")
+        if self._start is not None:
+            raise RuntimeError("can not add a stage after the pipeline started.")
+        kw.setdefault('on_full','block')
+        def _decorator(func):
+            i = len(self._stages)
+            g = gqueue or '{}.{}'.format(self.name,func.__name__)
+            p = pool(pool_num,gqueue=g,maxsize=self.maxsize if maxsize is None else maxsize,**kw)
+            @functools.wraps(func)
+            def _stage(item):
+                ret = func(item)
+                last = i + 1 == len(self._stages)
+                if isinstance(ret,types.GeneratorType):
+                    for x in ret:
+                        if not last: self._emit(i+1,x)
+                elif ret is not None and not last:
+                    self._emit(i+1,ret)
+            self._stages.append((g,p(_stage)))
+            self._blocked.append([0.,0])
+            return func
+        return _decorator
+
+    def _emit(self,i,item):
+        # 队列满的时候才计时，没有背压时不增加额外的开销
+        g, submit = self._stages[i]
+        if not pool._pool_queue[g].full():
+            submit(item)
+            return
+        t = time.perf_counter()
+        submit(item)
+        t = time.perf_counter() - t
+        with self._lock:
+            self._blocked[i][0] += t
+            self._blocked[i][1] += 1
+
+    def feed(self,item):
+        '''
+        #==============================================================
+        # 向第一个阶段提交一个数据，队列满了会阻塞
+        # 数据全部提交完之后需要执行 join 结束流水线
+        #==============================================================
+        '''
+        if self._closed:
+            raise RuntimeError("pipeline {!r} is closed.".format(self.name))
+        if not self._stages:
+            raise ValueError("pipeline {!r} has no stage.".format(self.name))
+        if self._start is None:
+            self._start = time.perf_counter()
+        self._emit(0,item)
+
+    def run(self,source,wait=True,timeout=None):
+        '''
+        #==============================================================
+        # 把 source 中的数据全部提交给第一个阶段，然后结束流水线
+        #     :wait     为 False 时在后台线程中提交数据并结束流水线，直接返回
+        #               此时可以用 join 等待，vthread.pool.wait 也会等待后台的提交
+        #     :timeout  wait=True 时结束流水线的最长等待时间
+        # wait=True 时返回 join 的结果
+        #==============================================================
+        '''
+        if not wait:
+            # 提交数据的过程也计入第一个阶段的任务数量，避免进程退出时数据还没有提交完
+            counter = pool._monitor_run_num[self._stages[0][0]]
+            counter.incr()
+            def _feed():
+                try:
+                    for item in source:
+                        self.feed(item)
+                finally:
+                    counter.decr()
+                self.join()
+            Thread(target=_feed,name='{}_feed'.format(self.name),daemon=True).start()
+            return None
+        for item in source:
+            self.feed(item)
+        return self.join(timeout)
+
+    def join(self,timeout=None):
+        '''
+        #==============================================================
+        # 结束流水线：按顺序等待每个阶段执行完毕，然后关闭该阶段的伺服线程
+        # 上游全部结束之后该阶段不会再有新的数据，这就是结束信号的传递
+        # 超时返回 False，此时流水线仍在执行，可以再次 join
+        #==============================================================
+        '''
+        end = None if timeout is None else time.time() + timeout
+        for g,_ in self._stages:
+            if not pool.wait(g,_remaining(end)):
+                return False
+            pool.close_by_gqueue(g)
+        self._closed = True
+        return True
+
+    def stats(self):
+        '''
+        #==============================================================
+        # 每个阶段的统计数据，在 vthread.pool.stats 的基础上增加
+        #     :stage            阶段的序号
+        #     :maxsize          阶段的队列容量
+        #     :throughput       从开始提交到现在平均每秒执行完的数据量
+        #     :blocked_seconds  上游因为该阶段队列已满而阻塞的总时间
+        #     :blocked_puts     上游因为该阶段队列已满而阻塞的次数
+        #==============================================================
+        '''
+        elapsed = 0. if self._start is None else time.perf_counter() - self._start
+        ret = []
+        for i,(g,_) in enumerate(self._stages):
+            st = pool.stats(g)
+            st["stage"]      = i
+            st["maxsize"]    = pool._pool_queue[g].maxsize
+            st["throughput"] = st["completed"] / elapsed if elapsed else 0.
+            with self._lock:
+                st["blocked_seconds"], st["blocked_puts"] = self._blocked[i]
+            ret.append(st)
+        return ret
 
 
 def atom(func):
@@ -542,6 +3128,13 @@ def unpatch_all(can_be_repatch=False):
 # 函数
 funcs = ["thread",
          "pool",
+         "ppool",
+         "pipeline",
+         "Future",
+         "RateLimiter",
+         "as_completed",
+         "cancel_token",
+         "worker_resource",
          "atom",
          "patch_print",
          "toggle",